@@ -0,0 +1,305 @@
+#!/bin/env python3
+""" benchmark.py measures the latency and throughput of SamsungSettingsDaemon without real hardware.
+
+It generates a fake sysfs tree (see fakesysfs.py) on a tmpfs, starts a private dbus-daemon
+and runs the daemon against both, so nothing on the real system bus or the real hardware is touched.
+
+The results are written as JSON so runs from different versions can be compared with --compare.
+"""
+import argparse
+import json
+import os
+import pathlib
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import pydbus
+from gi.repository import GLib
+
+import fakesysfs
+
+busname = "org.jordynsblog.SamsungSettingsDaemon"
+objpath = "/org/jordynsblog/SamsungSettingsDaemon"
+daemonpath = pathlib.Path(__file__).resolve().parent.parent / "daemon" / "SamsungSettingsDaemon.py"
+
+# A bus that lets anyone own and talk to anything, since it's only ever used by us.
+busconfig = """<!DOCTYPE busconfig PUBLIC "-//freedesktop//DTD D-BUS Bus Configuration 1.0//EN"
+ "http://www.freedesktop.org/standards/dbus/1.0/busconfig.dtd">
+<busconfig>
+    <listen>unix:path={socket}</listen>
+    <servicedir>{servicedir}</servicedir>
+    <auth>EXTERNAL</auth>
+    <policy context="default">
+        <allow user="*"/>
+        <allow own="*"/>
+        <allow send_destination="*"/>
+        <allow receive_sender="*"/>
+    </policy>
+</busconfig>
+"""
+
+# Lets the bus start the daemon on demand, like the system bus does with the installed activation file.
+activationfile = """[D-BUS Service]
+Name={name}
+Exec={command}
+"""
+
+def summarize(samples):
+    """ summarize() returns the sample count, p50, p99, min and max of a list of samples. """
+    samples = sorted(samples)
+    if not samples:
+        return {"n": 0}
+
+    def rank(percentile):
+        return samples[min(len(samples) - 1, round(percentile / 100 * (len(samples) - 1)))]
+
+    return {"n": len(samples), "p50": rank(50), "p99": rank(99), "min": samples[0], "max": samples[-1]}
+
+def getVersion():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd = daemonpath.parent, capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Harness():
+    """ The Harness() class owns the temporary directory, the private bus and the daemon process. """
+
+    def __init__(self, workdir, daemonargs):
+        self.workdir = pathlib.Path(workdir)
+        self.daemonargs = daemonargs
+        self.root = fakesysfs.create(self.workdir / "root")
+        self.settingsfile = self.workdir / "settings.json"
+        # Restore() needs a settings file to exist, an empty one just restores the defaults.
+        self.settingsfile.write_text("{}")
+        self.busprocess = None
+        self.daemonprocess = None
+        self.bus = None
+
+    def command(self, extra = []):
+        return [sys.executable, str(daemonpath), "--sysfsroot", str(self.root), "--settingsfile", str(self.settingsfile), "--disablesystemd"] + self.daemonargs + extra
+
+    def startBus(self):
+        configfile = self.workdir / "bus.conf"
+        servicedir = self.workdir / "services"
+        servicedir.mkdir()
+        socket = self.workdir / "bus.socket"
+        self.address = f"unix:path={socket}"
+        (servicedir / f"{busname}.service").write_text(activationfile.format(name = busname, command = " ".join(self.command(["--adopt", "--idletimeout", "60"]))))
+        configfile.write_text(busconfig.format(socket = socket, servicedir = servicedir))
+
+        # The session bus is pointed at our bus too so the daemon can't reach the real gsd-power
+        # and change the real keyboard backlight in the middle of a benchmark. Daemons started
+        # by the bus inherit this environment from it.
+        self.env = dict(os.environ, DBUS_SYSTEM_BUS_ADDRESS = self.address, DBUS_SESSION_BUS_ADDRESS = self.address)
+        self.busprocess = subprocess.Popen(["dbus-daemon", "--nofork", f"--config-file={configfile}", "--print-address=1"], stdout = subprocess.PIPE, stderr = open(self.workdir / "daemon.log", "a"), text = True, env = self.env)
+        self.busprocess.stdout.readline()
+        self.bus = pydbus.connect(self.address)
+
+    def startDaemon(self, timeout = 10):
+        """ startDaemon() starts the daemon and returns the seconds it took to answer its first call. """
+        log = open(self.workdir / "daemon.log", "a")
+
+        started = time.perf_counter()
+        self.daemonprocess = subprocess.Popen(self.command(), env = self.env, stdout = log, stderr = subprocess.STDOUT)
+        log.close()
+
+        while time.perf_counter() - started < timeout:
+            if self.daemonprocess.poll() is not None:
+                raise RuntimeError(f"Daemon exited with {self.daemonprocess.returncode}, see {self.workdir / 'daemon.log'}")
+
+            # Calling the name before our daemon owns it would make the bus start another one.
+            if not self.bus.dbus.NameHasOwner(busname):
+                time.sleep(0.001)
+                continue
+
+            try:
+                self.proxy = self.bus.get(busname, objpath)
+                self.proxy.moduleLoaded
+                return time.perf_counter() - started
+            except GLib.GError:
+                time.sleep(0.001)
+
+        raise RuntimeError(f"Daemon didn't show up on the bus within {timeout} seconds!")
+
+    def stopDaemon(self):
+        if self.daemonprocess is not None:
+            self.daemonprocess.send_signal(signal.SIGTERM)
+            self.daemonprocess.wait()
+            self.daemonprocess = None
+
+    def stop(self):
+        self.stopDaemon()
+        if self.busprocess is not None:
+            self.busprocess.terminate()
+            self.busprocess.wait()
+            self.busprocess = None
+
+def benchStartup(harness, samples):
+    results = [harness.startDaemon()]
+    for i in range(samples - 1):
+        harness.stopDaemon()
+        results.append(harness.startDaemon())
+
+    return summarize([x * 1000 for x in results])
+
+def benchActivation(harness, samples, timeout = 10):
+    """ benchActivation() measures the first call to a daemon that isn't running, which makes the bus start it. """
+    results = []
+    for i in range(samples):
+        started = time.perf_counter()
+        harness.bus.get(busname, objpath).moduleLoaded
+        results.append(time.perf_counter() - started)
+
+        # Stop it again so the next call has to start a new one.
+        os.kill(harness.bus.dbus.GetConnectionUnixProcessID(busname), signal.SIGTERM)
+        while harness.bus.dbus.NameHasOwner(busname):
+            if time.perf_counter() - started > timeout:
+                raise RuntimeError("The activated daemon didn't exit!")
+            time.sleep(0.001)
+
+    return summarize([x * 1000 for x in results])
+
+def getRSS(pid):
+    """ getRSS() returns the resident memory of a process in KiB. """
+    for line in pathlib.Path(f"/proc/{pid}/status").read_text().splitlines():
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1])
+
+def timeUntilSignalled(proxy, key, action, samples, timeout):
+    """ timeUntilSignalled() calls action(i) samples times and measures how long it takes for PropertiesChanged to report key. """
+    context = GLib.MainContext.default()
+    received = []
+
+    def handle_properties_changed(iface, changed, invalidated):
+        if key in changed:
+            received.append(time.perf_counter())
+
+    subscription = proxy.PropertiesChanged.connect(handle_properties_changed)
+    results = []
+    missed = 0
+    for i in range(samples):
+        received.clear()
+        timedout = []
+
+        started = time.perf_counter()
+        action(i)
+        timer = GLib.timeout_add(int(timeout * 1000), lambda: timedout.append(True))
+        while not received and not timedout:
+            context.iteration(True)
+
+        if received:
+            GLib.source_remove(timer)
+            results.append(received[0] - started)
+        else:
+            missed += 1
+
+    subscription.disconnect()
+    return dict(summarize([x * 1000 for x in results]), missed = missed)
+
+def benchSetter(proxy, samples, timeout):
+    """ benchSetter() measures the time from setting a property to the PropertiesChanged signal saying it's written. """
+    # Step through the values from the current one so the daemon can't skip the write as a no-op.
+    current = proxy.perfMode
+    def setPerfMode(i):
+        proxy.perfMode = (current + i + 1) % 4
+
+    return timeUntilSignalled(proxy, "perfMode", setPerfMode, samples, timeout)
+
+def benchRestore(proxy, samples, timeout):
+    """ benchRestore() measures the time from calling Restore() to the PropertiesChanged signal sent once it's all written. """
+    return timeUntilSignalled(proxy, "perfMode", lambda i: proxy.Restore(), samples, timeout)
+
+def benchPropagation(harness, proxy, samples, timeout):
+    """ benchPropagation() measures the time from an external /sys write to the PropertiesChanged signal. """
+    attr = harness.root / "sys/bus/platform/devices/samsung-galaxybook/start_on_lid_open"
+    value = int(attr.read_text())
+    def flipAttribute(i):
+        attr.write_text(f"{(value + i + 1) % 2}\n")
+
+    return timeUntilSignalled(proxy, "startOnLidOpen", flipAttribute, samples, timeout)
+
+def benchSaveBurst(proxy, bursts, size):
+    """ benchSaveBurst() fires bursts of Save() calls and measures per-call latency and throughput. """
+    latencies = []
+    throughput = []
+    for i in range(bursts):
+        started = time.perf_counter()
+        for j in range(size):
+            callstarted = time.perf_counter()
+            proxy.Save()
+            latencies.append(time.perf_counter() - callstarted)
+        throughput.append(size / (time.perf_counter() - started))
+
+    return {"latency_ms": summarize([x * 1000 for x in latencies]), "calls_per_second": summarize(throughput)}
+
+def compare(old, new):
+    """ compare() prints the p50/p99 changes between two result files. """
+    def flatten(results, prefix = ""):
+        for key, value in results.items():
+            if isinstance(value, dict) and "n" not in value:
+                yield from flatten(value, f"{prefix}{key}.")
+            elif isinstance(value, dict):
+                yield f"{prefix}{key}", value
+
+    oldresults = dict(flatten(old["results"]))
+    print(f"Comparing {old.get('version')} -> {new.get('version')}")
+    for name, stats in flatten(new["results"]):
+        if name not in oldresults:
+            continue
+
+        for stat in ["p50", "p99"]:
+            if stat not in stats or stat not in oldresults[name]:
+                continue
+
+            before = oldresults[name][stat]
+            after = stats[stat]
+            change = (after - before) / before * 100 if before else 0
+            print(f"{name + ' ' + stat:<45} {before:>12.3f} {after:>12.3f} {change:>+8.1f}%")
+
+parser = argparse.ArgumentParser(prog = "benchmark", description = "Benchmarks SamsungSettingsDaemon against a fake sysfs tree on a private D-Bus daemon.")
+parser.add_argument("-n", "--samples", default = 200, type = int, help = "Samples for the setter and Restore() benchmarks")
+parser.add_argument("--startups", default = 5, type = int, help = "Number of times to start the daemon when measuring startup-to-first-reply latency")
+parser.add_argument("--activations", default = 5, type = int, help = "Number of times to have the bus start the daemon on demand when measuring activation-to-first-reply latency")
+parser.add_argument("--propagation", default = 20, type = int, help = "Samples for the external change propagation benchmark")
+parser.add_argument("--propagationtimeout", default = 5.0, type = float, help = "Seconds to wait for a PropertiesChanged signal before counting it as missed")
+parser.add_argument("--bursts", default = 20, type = int, help = "Number of Save() bursts")
+parser.add_argument("--burstsize", default = 50, type = int, help = "Save() calls per burst")
+parser.add_argument("--tmpdir", default = "/dev/shm" if os.path.isdir("/dev/shm") else None, help = "Where to create the fake tree (a tmpfs by default)")
+parser.add_argument("-k", "--keep", action = "store_true", help = "Keep the temporary directory (and daemon.log) around afterwards")
+parser.add_argument("-o", "--output", type = pathlib.Path, help = "Write the results to this file instead of stdout")
+parser.add_argument("-c", "--compare", type = pathlib.Path, help = "Compare the results against an earlier results file")
+parser.add_argument("daemonargs", nargs = argparse.REMAINDER, help = "Extra arguments for the daemon (after --)")
+args = parser.parse_args()
+
+daemonargs = [x for x in args.daemonargs if x != "--"]
+workdir = tempfile.mkdtemp(prefix = "SamsungSettingsBench.", dir = args.tmpdir)
+harness = Harness(workdir, ["--maxpollinterval", "1"] + daemonargs)
+try:
+    harness.startBus()
+    results = {"startup_to_first_reply_ms": benchStartup(harness, args.startups)}
+    results["setter_applied_ms"] = benchSetter(harness.proxy, args.samples, args.propagationtimeout)
+    results["restore_applied_ms"] = benchRestore(harness.proxy, args.samples, args.propagationtimeout)
+    results["propagation_ms"] = benchPropagation(harness, harness.proxy, args.propagation, args.propagationtimeout)
+    results["save_burst"] = benchSaveBurst(harness.proxy, args.bursts, args.burstsize)
+    results["resident_rss_kib"] = getRSS(harness.daemonprocess.pid)
+    harness.stopDaemon()
+    results["activation_to_first_reply_ms"] = benchActivation(harness, args.activations)
+finally:
+    harness.stop()
+    if args.keep:
+        print(f"Kept {workdir}", file = sys.stderr)
+    else:
+        shutil.rmtree(workdir)
+
+output = {"version": getVersion(), "python": sys.version.split()[0], "time": time.time(), "daemonargs": daemonargs, "results": results}
+if args.output:
+    args.output.write_text(json.dumps(output, indent = 4))
+else:
+    print(json.dumps(output, indent = 4))
+
+if args.compare:
+    compare(json.loads(args.compare.read_text()), output)
@@ -0,0 +1,49 @@
+#!/bin/env python3
+""" fakesysfs.py generates a fake samsung-galaxybook sysfs tree for development and benchmarking.
+
+The tree mirrors the layout the daemon expects under its --sysfsroot, so the daemon can be
+run against it without the real hardware or kernel module. Putting it on a tmpfs (like /dev/shm)
+keeps file I/O out of the measurements.
+
+NB: regular files never raise POLLPRI, so the daemon falls back to polling every attribute
+in a fake tree. Propagation latencies measured against it are polling latencies.
+"""
+import argparse
+import pathlib
+
+# Attribute paths relative to the root and their initial values
+tree = {
+    "sys/bus/platform/devices/samsung-galaxybook/usb_charging": "0",
+    "sys/bus/platform/devices/samsung-galaxybook/performance_mode": "0",
+    "sys/bus/platform/devices/samsung-galaxybook/battery_saver": "0",
+    "sys/bus/platform/devices/samsung-galaxybook/start_on_lid_open": "0",
+    "sys/class/leds/samsung-galaxybook::kbd_backlight/brightness": "0",
+    "sys/class/leds/samsung-galaxybook::kbd_backlight/max_brightness": "3",
+    "sys/class/power_supply/AC/type": "Mains",
+    "sys/class/power_supply/AC/online": "1",
+    "sys/class/power_supply/BAT1/type": "Battery",
+    "sys/class/power_supply/BAT1/charge_control_end_threshold": "100",
+    "sys/class/power_supply/BAT1/power_now": "12500000",
+    "sys/class/hwmon/hwmon0/name": "coretemp",
+    "sys/class/hwmon/hwmon0/temp1_input": "45000",
+    "sys/class/hwmon/hwmon0/temp1_label": "Package id 0",
+    "sys/class/hwmon/hwmon1/name": "samsung_galaxybook",
+    "sys/class/hwmon/hwmon1/fan1_input": "0"
+}
+
+def create(root):
+    """ create() writes the fake tree below root and returns root as a pathlib.Path. """
+    root = pathlib.Path(root)
+    for path, value in tree.items():
+        file = root / path
+        file.parent.mkdir(parents = True, exist_ok = True)
+        file.write_text(f"{value}\n")
+
+    return root
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog = "fakesysfs", description = "Generates a fake samsung-galaxybook sysfs tree.")
+    parser.add_argument("root", type = pathlib.Path, help = "Directory to create the tree in (ideally on a tmpfs)")
+    args = parser.parse_args()
+
+    print(f"Created fake sysfs tree in {create(args.root)}")
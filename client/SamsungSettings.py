@@ -1,15 +1,344 @@
 #!/bin/env python3
+import time
+starttime = time.perf_counter()
+
+# Only the D-Bus layer is imported up here. GTK and libadwaita take a lot longer to load than the
+# rest of the client, and the command line modes (--inckey is bound to a hardware key!) never open
+# a window, so those are only imported further down once we know we're running the GUI.
 import sys
-import gi
-gi.require_version('Gtk', '4.0')
-gi.require_version('Adw', '1')
-from gi.repository import Gtk, Adw
 import argparse
 import pydbus
+from gi.repository import GLib, Gio
 import os
 import pathlib
+import json
+import logging
+import csv
+
+# D-Bus types of the daemon's settings, used to wrap values for SetMany(). Settings the daemon
+# discovered on it's own aren't listed here, they're always integers ("i").
+settingtypes = {
+    "usbCharging": "b",
+    "perfMode": "n",
+    "kbdBacklight": "n",
+    "batterySaver": "b",
+    "startOnLidOpen": "b",
+    "chargeEndThreshold": "n"
+}
+
+def setSettings(proxy, values, persist = True):
+    """ setSettings() changes any number of settings using a single SetMany() call.
+
+    This replaces setting each property and then calling Save(), which costs two round trips
+    per setting and makes the daemon rewrite settings.json for every one of them.
+    """
+    variants = {key: GLib.Variant(settingtypes.get(key, "i"), values[key]) for key in values}
+    return proxy.SetMany(variants, persist)
+
+def parseSetting(setting):
+    """ parseSetting() turns a KEY=VALUE string from the command line into a (key, value) tuple. """
+    key, sep, val = setting.partition("=")
+    if not sep or not key:
+        raise argparse.ArgumentTypeError(f"{setting} is not in the form KEY=VALUE with KEY being one of {', '.join(settingtypes)} or another setting the daemon has")
+
+    if settingtypes.get(key) == "b":
+        if val.lower() not in ["0", "1", "true", "false", "on", "off"]:
+            raise argparse.ArgumentTypeError(f"{key} must be a boolean!")
+        return key, val.lower() in ["1", "true", "on"]
+
+    try:
+        return key, int(val)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{key} must be an integer!")
+
+class StateMirror():
+    """ The StateMirror() class keeps a local copy of all of the daemon's properties.
+
+    It's filled using a single GetAll() call and kept up to date from the daemon's PropertiesChanged
+    signal, so reading a setting never needs a D-Bus round trip. Listeners added with connect() are
+    called with the dictonary of changed properties whenever the daemon reports a change, and with
+    every property once GetAll() returns.
+
+    Nothing blocks: start() only sends the call, and ready is called with None once the state
+    has arrived or with the GLib.GError if it couldn't be fetched.
+    """
+
+    busname = "org.jordynsblog.SamsungSettingsDaemon"
+    objpath = "/org/jordynsblog/SamsungSettingsDaemon"
+    interface = "org.jordynsblog.SamsungSettingsDaemon"
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.state = {}
+        self.listeners = []
+        self.ready = None
+
+    def __getitem__(self, key):
+        return self.state[key]
+
+    def connect(self, callback):
+        self.listeners.append(callback)
+
+    def start(self, ready):
+        self.ready = ready
+
+        # Subscribe before calling GetAll() so no change can slip in between the two.
+        self.subscription = self.connection.signal_subscribe(self.busname, "org.freedesktop.DBus.Properties", "PropertiesChanged",
+            self.objpath, self.interface, Gio.DBusSignalFlags.NONE, self.handle_properties_changed, None)
+        self.connection.call(self.busname, self.objpath, "org.freedesktop.DBus.Properties", "GetAll", GLib.Variant("(s)", (self.interface,)),
+            GLib.VariantType("(a{sv})"), Gio.DBusCallFlags.NONE, -1, None, self.handle_getall_reply, None)
+
+    def handle_getall_reply(self, connection, result, user_data):
+        try:
+            state, = connection.call_finish(result).unpack()
+        except GLib.GError as e:
+            self.ready(e)
+            return
+
+        self.update(state)
+        self.ready(None)
+
+    def handle_properties_changed(self, connection, sender, path, iface, signal, parameters, user_data):
+        iface, changed, invalidated = parameters.unpack()
+        if iface == self.interface:
+            self.update(changed)
+
+    def update(self, changed):
+        self.state.update(changed)
+        for callback in self.listeners:
+            callback(changed)
+
+class LatestWinsCoalescer():
+    """ The LatestWinsCoalescer() class sends setting changes without blocking and without piling them up.
+
+    At most one SetMany() call is in flight at a time. Changes made while one is in flight replace
+    each other, and only the newest values are sent once it returns. Dragging a slider therefore never
+    stalls the GTK main loop on D-Bus round trips or floods the daemon with intermediate values,
+    while the hardware still ends up at wherever the slider stopped.
+
+    The daemon replies as soon as the values are queued and only signals them once they're written,
+    so the values of earlier calls can still come back after a newer call returned. outdated() says
+    which of the daemon's updates are older than what we sent: everything for a setting while a newer
+    value is queued or in flight, and after that everything until the value sent last comes back.
+    If it never does (the write failed, or another change replaced it), the setting is settled again
+    once the daemon sends WriteFailed for it or after settletime seconds, and settled(key) is called
+    so the caller can show whatever the daemon holds.
+    """
+
+    log = logging.getLogger("LatestWinsCoalescer")
+
+    busname = "org.jordynsblog.SamsungSettingsDaemon"
+    objpath = "/org/jordynsblog/SamsungSettingsDaemon"
+    interface = "org.jordynsblog.SamsungSettingsDaemon"
+
+    settletime = 2
+
+    def __init__(self, connection, settled = None):
+        self.connection = connection
+        self.settled = settled
+        self.pending = {}
+        # The values sent in the SetMany() call that's in flight, None while there isn't one.
+        self.inflight = None
+
+        # key -> the value sent last that hasn't come back from the daemon yet
+        self.sent = {}
+        # key -> GLib source id of the timer that stops waiting for it
+        self.timers = {}
+
+        self.connection.signal_subscribe(self.busname, self.interface, "WriteFailed", self.objpath, None,
+            Gio.DBusSignalFlags.NONE, self.handle_write_failed, None)
+
+    def set(self, key, value):
+        self.pending[key] = value
+        if self.inflight is None:
+            self.send()
+
+    def busy(self, key):
+        """ busy() returns whether a value for key is waiting to be sent or in flight. """
+        return key in self.pending or (self.inflight is not None and key in self.inflight)
+
+    def outdated(self, key, value):
+        """ outdated() returns whether value, reported by the daemon for key, is older than the value we sent for it. """
+        if self.busy(key):
+            return True
+
+        if key not in self.sent:
+            return False
+
+        if value == self.sent[key]:
+            self.forget(key)
+            return False
+
+        return True
+
+    def forget(self, key):
+        self.sent.pop(key, None)
+        if key in self.timers:
+            GLib.source_remove(self.timers.pop(key))
+
+    def settle(self, key):
+        self.forget(key)
+        if self.settled is not None and not self.busy(key):
+            self.settled(key)
+
+    def send(self):
+        values, self.pending = self.pending, {}
+        variants = {key: GLib.Variant(settingtypes.get(key, "i"), values[key]) for key in values}
+        self.inflight = values
+        for key, value in values.items():
+            self.forget(key)
+            self.sent[key] = value
+            self.timers[key] = GLib.timeout_add_seconds(self.settletime, self.handle_settle_timeout, key)
+
+        self.connection.call(self.busname, self.objpath, self.interface,
+            "SetMany", GLib.Variant("(a{sv}b)", (variants, True)), GLib.VariantType("(s)"), Gio.DBusCallFlags.NONE, -1, None, self.handle_reply, None)
+
+    def handle_reply(self, connection, result, user_data):
+        values, self.inflight = self.inflight, None
+        try:
+            connection.call_finish(result)
+        except GLib.GError as e:
+            self.log.error("Failed to change settings: %s", e.message)
+            # None of them were queued, so none of them are coming back.
+            for key in values:
+                if self.sent.get(key) == values[key]:
+                    self.settle(key)
+
+        if self.pending:
+            self.send()
+
+    def handle_write_failed(self, connection, sender, path, iface, signal, parameters, user_data):
+        key, value, error = parameters.unpack()
+        self.log.error("The daemon failed to set %s to %s: %s", key, value, error)
+        if self.sent.get(key) == value:
+            self.settle(key)
+
+    def handle_settle_timeout(self, key):
+        del self.timers[key]
+        self.settle(key)
+        return False
+
+def reportTiming(stage):
+    """ reportTiming() prints how long it's been since the client started if --timing was given. """
+    if args.timing:
+        print(f"[TIMING] {stage}: {(time.perf_counter() - starttime) * 1000:.1f} ms since startup")
+
+parser = argparse.ArgumentParser(prog = "SamsungSettings", description = "A clone of Samsung Settings for Linux using the samsung-galaxybook kernel module.")
+parser.add_argument("-r", "--restore", action = "store_true", help = "Restores saved settings on module reload or a reboot.")
+parser.add_argument("-k", "--inckey", action = "store_true" , help = "Increments the keyboard backlight and wraps back around at 100 percent.")
+parser.add_argument("-p", "--cycleperf", action = "store_true", help = "Switches to the next performance mode and wraps back around after High performance.")
+parser.add_argument("-P", "--profile", metavar = "NAME", help = "Switches to a named profile (battery, balanced, max or your own) then exits.")
+parser.add_argument("-s", "--set", action = "append", type = parseSetting, metavar = "KEY=VALUE", help = "Changes one or more settings in a single call then exits. Can be given multiple times.")
+parser.add_argument("-S", "--stats", action = "store_true", help = "Prints the daemon's timing statistics and counters then exits.")
+parser.add_argument("-T", "--telemetry", metavar = "SECONDS", type = float, help = "Prints the daemon's temperature, fan and power samples from the last SECONDS as CSV then exits.")
+parser.add_argument("--maxpoints", default = 0, type = int, help = "Limits --telemetry to about this many rows by using the daemon's averaged samples (0 for no limit).")
+parser.add_argument("-u", "--uifile", required = False, type = pathlib.Path, help = "Sets the location for the UI file.")
+parser.add_argument("-l", "--loglevel", default = "WARNING", choices = ["DEBUG", "INFO", "WARNING", "ERROR"], help = "Only prints log messages of at least this level.")
+parser.add_argument("-t", "--timing", action = "store_true", help = "Prints how long startup took.")
+args = parser.parse_args()
+
+logging.basicConfig(level = args.loglevel, format = "[%(levelname)s] [%(name)s] %(message)s")
+log = logging.getLogger("Main")
+
+reportTiming("D-Bus layer imported and arguments parsed")
+
+if args.restore:
+    # Restore
+    log.debug("Restoring settings then exiting!")
+    bus = pydbus.SystemBus()
+    proxy = bus.get("org.jordynsblog.SamsungSettingsDaemon", "/org/jordynsblog/SamsungSettingsDaemon")
+    if not proxy.moduleLoaded:
+        log.error("Cannot restore settings as samsung-galaxybook is not loaded or /sys/bus/platform/devices/samsung-galaxybook is otherwise missing!")
+        raise SystemExit(1)
+    proxy.Restore()
+    reportTiming("restore done")
+    raise SystemExit(0)
+elif args.set:
+    log.debug("Changing %s setting(s) then exiting!", len(args.set))
+    bus = pydbus.SystemBus()
+    proxy = bus.get("org.jordynsblog.SamsungSettingsDaemon", "/org/jordynsblog/SamsungSettingsDaemon")
+    setSettings(proxy, dict(args.set))
+    reportTiming("settings changed")
+    raise SystemExit(0)
+elif args.profile:
+    bus = pydbus.SystemBus()
+    proxy = bus.get("org.jordynsblog.SamsungSettingsDaemon", "/org/jordynsblog/SamsungSettingsDaemon")
+
+    if args.profile not in proxy.GetProfiles():
+        log.error("Unknown profile %s! Available profiles are: %s", args.profile, ', '.join(proxy.GetProfiles()))
+        raise SystemExit(1)
+
+    proxy.ApplyProfile(args.profile)
+    reportTiming("profile applied")
+    raise SystemExit(0)
+elif args.stats:
+    bus = pydbus.SystemBus()
+    proxy = bus.get("org.jordynsblog.SamsungSettingsDaemon", "/org/jordynsblog/SamsungSettingsDaemon")
+    stats = json.loads(proxy.GetStats())
+
+    print(f"Daemon uptime: {stats['uptime']:.0f} seconds")
+    print(f"Saves: {stats['saves']['requested']} requested, {stats['saves']['written']} written, {stats['saves']['coalesced']} coalesced")
+    print()
+    print(f"{'Operation':<40} {'Count':>8} {'Mean':>10} {'p50':>10} {'p99':>10} {'Max':>10} (microseconds)")
+    for name, histogram in sorted(stats["histograms"].items()):
+        print(f"{name:<40} {histogram['count']:>8} {histogram['mean_us']:>10.0f} {histogram['p50_us']:>10.0f} {histogram['p99_us']:>10.0f} {histogram['max_us']:>10.0f}")
+    print()
+    print(f"{'Counter':<40} {'Count':>8}")
+    for name, count in sorted(stats["counters"].items()):
+        print(f"{name:<40} {count:>8}")
+    raise SystemExit(0)
+elif args.telemetry:
+    bus = pydbus.SystemBus()
+    proxy = bus.get("org.jordynsblog.SamsungSettingsDaemon", "/org/jordynsblog/SamsungSettingsDaemon")
+
+    # The whole window comes back in a single call, ready for gnuplot or a spreadsheet.
+    channels, timestamps, values = proxy.GetTelemetry(time.time() - args.telemetry, 0, args.maxpoints)
+    if not channels:
+        log.error("The daemon isn't collecting telemetry, start it with --telemetryinterval!")
+        raise SystemExit(1)
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(["time"] + channels)
+    for i, timestamp in enumerate(timestamps):
+        writer.writerow([f"{timestamp:.1f}"] + [f"{column[i]:.3f}" for column in values])
+    raise SystemExit(0)
+elif args.inckey:
+    bus = pydbus.SystemBus()
+    proxy = bus.get("org.jordynsblog.SamsungSettingsDaemon", "/org/jordynsblog/SamsungSettingsDaemon")
+
+    # The daemon does the increment itself so it takes a single call and quick presses can't race.
+    value = proxy.CycleKeyboardBacklight()
+    log.debug("Keyboard backlight is now %s!", value)
+    reportTiming("keyboard backlight changed")
+    raise SystemExit(0)
+elif args.cycleperf:
+    bus = pydbus.SystemBus()
+    proxy = bus.get("org.jordynsblog.SamsungSettingsDaemon", "/org/jordynsblog/SamsungSettingsDaemon")
+
+    value = proxy.CyclePerfMode()
+    log.debug("Performance mode is now %s!", value)
+    reportTiming("performance mode changed")
+    raise SystemExit(0)
+
+# Everything from here on is GUI only.
+import gi
+gi.require_version('Gtk', '4.0')
+gi.require_version('Adw', '1')
+from gi.repository import Gtk, Adw
+
+reportTiming("GTK and libadwaita imported")
 
 class MyApp(Adw.Application):
+    log = logging.getLogger("MyApp")
+
+    # The UI compiled into a GResource by the Makefile, either next to this file (in the source tree)
+    # or where make install puts it. Loading it is a single mmap() instead of a search for the .ui file.
+    resourcefiles = [
+        pathlib.Path(__file__).resolve().parent / "SamsungSettings.gresource",
+        pathlib.Path(__file__).resolve().parent.parent / "share" / "SamsungSettings" / "SamsungSettings.gresource"
+    ]
+    resourcepath = "/org/jordynsblog/SamsungSettings/SamsungSettings.ui"
+
     def __init__(self, uifile, **kwargs):
         super().__init__(**kwargs)
         self.uifile = uifile
@@ -29,160 +358,193 @@ class MyApp(Adw.Application):
 
         # Path 1: Check explicitly given paths
         if self.uifile and self.uifile.exists():
-            print(f"[DEBUG] [MyApp] Using explicitly given path ({self.uifile}) for UI file!")
+            self.log.debug("Using explicitly given path (%s) for UI file!", self.uifile)
             return self.uifile
 
         # Path 2: Search all of XDG_DATA_DIRS for it
         for datapath in datapaths:
             uifile = datapath / "SamsungSettings" / "SamsungSettings.ui"
             if uifile.exists():
-                print(f"[DEBUG] [MyApp] Using {uifile} found using XDG_DATA_DIRS!")
+                self.log.debug("Using %s found using XDG_DATA_DIRS!", uifile)
                 return uifile
             else:
-                print(f"[DEBUG] [MyApp] Not using {uifile} because it doesn't exist!")
+                self.log.debug("Not using %s because it doesn't exist!", uifile)
         
         # Path 3: It hasn't been found any other way so far... let's just use the one in the current directory.
         uifile = pathlib.Path("SamsungSettings.ui")
         if uifile.exists():
-            print(f"[DEBUG] [MyApp] Using default UI file path of the current directory!")
+            self.log.debug("Using default UI file path of the current directory!")
             return uifile
         else:
-            print(f"[ERROR] [MyApp] UI file not found using any of the above attempts... exiting!")
+            self.log.error("UI file not found using any of the above attempts... exiting!")
             raise SystemExit(1)
 
-    def on_activate(self, app):
-        # Create a Builder
+    def loadUI(self):
+        """ loadUI() returns a Gtk.Builder() with the UI loaded.
+
+        Unless a UI file was given with --uifile, the compiled GResource is used if it's installed,
+        and the .ui file is only searched for if it isn't.
+        """
         builder = Gtk.Builder()
+        if self.uifile is None:
+            for resourcefile in self.resourcefiles:
+                try:
+                    Gio.resources_register(Gio.Resource.load(str(resourcefile)))
+                except GLib.GError:
+                    continue
+
+                self.log.debug("Using UI from %s!", resourcefile)
+                builder.add_from_resource(self.resourcepath)
+                return builder
+
         builder.add_from_file(str(self.__searchForUIFile__()))
+        return builder
 
-        # Grab D-Bus instance to the daemon
-        bus = pydbus.SystemBus()
-        try:
-            self.proxy = bus.get("org.jordynsblog.SamsungSettingsDaemon", "/org/jordynsblog/SamsungSettingsDaemon")
-        except gi.repository.GLib.GError:
-            print(f"[ERROR] Failed to obtain a handle to the daemon on D-Bus... is it running???")
-            daemonNotFoundDialog = builder.get_object("daemonNotFoundError")
-            daemonNotFoundDialog.connect("response", lambda dialog, response: exit(1))
-            daemonNotFoundDialog.set_application(self)
-            daemonNotFoundDialog.present()
-            return
+    def on_activate(self, app):
+        # Start connecting to the daemon right away. The replies are handled by the main loop
+        # once the window is up, so the D-Bus round trips happen while the UI is being built.
+        Gio.bus_get(Gio.BusType.SYSTEM, None, self.handleBusReady)
+
+        self.builder = self.loadUI()
+        reportTiming("UI loaded")
+
+        # Connect Setting widgets to their proper handlers.
+        # The handler IDs are kept around so handlers can be blocked while the widgets are
+        # updated from the daemon's side, otherwise every update would be sent straight back.
+        self.usbChgButton = self.builder.get_object("usbChgButton")
+        self.performanceMode = self.builder.get_object("box")
+        self.kbdBacklight = self.builder.get_object("but")
+        self.batterySaver = self.builder.get_object("batterySaverSwitch")
+        self.startOnLidOpen = self.builder.get_object("startOnLidOpenSwitch")
+
+        self.widgets = {
+            "usbCharging": (self.usbChgButton, self.usbChgButton.connect("state-set", self.handleUSBCharging)),
+            "perfMode": (self.performanceMode, self.performanceMode.connect("notify::selected", self.handlePerformanceMode)),
+            "kbdBacklight": (self.kbdBacklight, self.kbdBacklight.connect("value-changed", self.handleKeyboardBacklight)),
+            "batterySaver": (self.batterySaver, self.batterySaver.connect("state-set", self.handleBatterySaver)),
+            "startOnLidOpen": (self.startOnLidOpen, self.startOnLidOpen.connect("state-set", self.handleStartOnLidOpen))
+        }
+
+        # The controls stay disabled until the daemon's state has arrived and is shown in them.
+        for widget, handlerid in self.widgets.values():
+            widget.set_sensitive(False)
 
-        # Connect Setting widgets to their proper handlers and sync with the
-        # settings file.
-        self.usbChgButton = builder.get_object("usbChgButton")
-        self.usbChgButton.connect("state-set", self.handleUSBCharging)
-        self.usbChgButton.set_state(self.proxy.usbCharging)
+        # Obtain and show the main window
+        self.win = self.builder.get_object("mainWindow")
+        self.win.set_application(self)  # Application will close once it no longer has active windows attached to it
+        self.win.present()
 
-        self.performanceMode = builder.get_object("box")
-        self.performanceMode.connect("notify::selected", self.handlePerformanceMode)
-        self.performanceMode.set_selected(self.proxy.perfMode)
+        clock = self.win.get_frame_clock()
+        if clock is not None:
+            self.firstframe = clock.connect("after-paint", self.handleFirstFrame)
 
-        self.kbdBacklight = builder.get_object("but")
-        self.kbdBacklight.connect("value-changed", self.handleKeyboardBacklight)
-        self.kbdBacklight.set_value(self.proxy.kbdBacklight)
+    def handleFirstFrame(self, clock):
+        clock.disconnect(self.firstframe)
+        reportTiming("first frame drawn")
 
-        self.batterySaver = builder.get_object("batterySaverSwitch")
-        self.batterySaver.connect("state-set", self.handleBatterySaver)
-        self.batterySaver.set_state(self.proxy.batterySaver)
+    def handleBusReady(self, source, result):
+        try:
+            connection = Gio.bus_get_finish(result)
+        except GLib.GError as e:
+            self.handleDaemonNotFound(e)
+            return
 
-        self.startOnLidOpen = builder.get_object("startOnLidOpenSwitch")
-        self.startOnLidOpen.connect("state-set", self.handleStartOnLidOpen)
-        self.startOnLidOpen.set_state(self.proxy.startOnLidOpen)
+        self.setter = LatestWinsCoalescer(connection, self.handleSettled)
+        self.state = StateMirror(connection)
+        self.state.connect(self.handleDaemonChange)
+        self.state.start(self.handleStateReady)
 
-        # Obtain and show the main window
-        self.win = builder.get_object("mainWindow")
-        self.win.set_application(self)  # Application will close once it no longer has active windows attached to it
+    def handleStateReady(self, error):
+        if error is not None:
+            self.handleDaemonNotFound(error)
+            return
 
-        # Check for module and show warning dialog if it doesn't exist before presenting the primary window.
-        if not self.proxy.moduleLoaded:
-            print("[WARNING] samsung-galaxybook kernel module is not loaded... settings will NOT take effect!")
-            print("See https://github.com/joshuagrisham/samsung-galaxybook-extras on how to install it.")
-            kmodNotFoundDialog = builder.get_object("kmodNotFoundError")
-            kmodNotFoundDialog.connect("response", self.handleKmodNotFoundDialog)
+        reportTiming("daemon state received")
+        for widget, handlerid in self.widgets.values():
+            widget.set_sensitive(True)
+
+        # Check for module and show warning dialog if it doesn't exist.
+        if not self.state["moduleLoaded"]:
+            self.log.warning("samsung-galaxybook kernel module is not loaded... settings will NOT take effect!")
+            self.log.warning("See https://github.com/joshuagrisham/samsung-galaxybook-extras on how to install it.")
+            kmodNotFoundDialog = self.builder.get_object("kmodNotFoundError")
             kmodNotFoundDialog.set_application(self)
             kmodNotFoundDialog.present()
-            return
 
-        self.win.present()
+    def handleDaemonNotFound(self, error):
+        self.log.error("Failed to obtain a handle to the daemon on D-Bus (%s)... is it running???", error.message)
+        daemonNotFoundDialog = self.builder.get_object("daemonNotFoundError")
+        daemonNotFoundDialog.connect("response", lambda dialog, response: exit(1))
+        daemonNotFoundDialog.set_application(self)
+        daemonNotFoundDialog.present()
 
-    # This is not a static method as this function needs a reference to the original main window
-    # to function correctly.
-    def handleKmodNotFoundDialog(self, dialog, response):
-        self.win.present()
+    def handleDaemonChange(self, changed):
+        """ handleDaemonChange() updates the widgets when settings change on the daemon's side.
+
+        That covers our own changes coming back, other clients, and hardware keys alike. Values
+        older than the one we last sent are skipped, otherwise the echoes of older values would
+        snap a slider back while it's being dragged.
+        """
+        for key in changed:
+            if key in self.widgets and not self.setter.outdated(key, changed[key]):
+                self.setWidget(key, changed[key])
+
+    def handleSettled(self, key):
+        """ handleSettled() shows the daemon's value for a setting whose last sent value never came back. """
+        if key in self.widgets and key in self.state.state:
+            self.setWidget(key, self.state[key])
+
+    def setWidget(self, key, value):
+        widget, handlerid = self.widgets[key]
+        with widget.handler_block(handlerid):
+            if key == "perfMode":
+                widget.set_selected(value)
+            elif key == "kbdBacklight":
+                widget.set_value(value)
+            else:
+                widget.set_state(value)
 
     def handleKeyboardBacklight(self, object):
-        val = object.get_value()
-        self.proxy.kbdBacklight = val
-        self.proxy.Save()
+        val = int(object.get_value())
+        self.setter.set("kbdBacklight", val)
 
     def handlePerformanceMode(self, obj, pspec):
         perfmodes = ["Silent", "Quiet", "Optimized", "High performance"] # NOTE: These are used for logging only
         selected = obj.get_selected()
-        print(f"Changing performance mode to: {perfmodes[selected]}")
-        self.proxy.perfMode = selected
-        self.proxy.Save()
+        self.log.debug("Changing performance mode to: %s", perfmodes[selected])
+        self.setter.set("perfMode", selected)
 
     def handleUSBCharging(self, switch, state):
         if state:
-            print("[DEBUG] Turning USB Charging on!")
+            self.log.debug("Turning USB Charging on!")
         else:
-            print("[DEBUG] Turning USB Charging off!")
+            self.log.debug("Turning USB Charging off!")
 
-        self.proxy.usbCharging = state
-        self.proxy.Save()
+        self.setter.set("usbCharging", state)
 
         # True stops other signals from emitting
         return False
 
     def handleBatterySaver(self, switch, state):
         if state:
-            print(f"[DEBUG] Turning Battery Saver on!")
+            self.log.debug("Turning Battery Saver on!")
         else:
-            print(f"[DEBUG] Turning Battery Saver off!")
+            self.log.debug("Turning Battery Saver off!")
 
-        self.proxy.batterySaver = state
-        self.proxy.Save()
+        self.setter.set("batterySaver", state)
 
         return False
 
     def handleStartOnLidOpen(self, switch, state):
         if state:
-            print(f"[DEBUG] Turning Start On Lid Open on!")
+            self.log.debug("Turning Start On Lid Open on!")
         else:
-            print(f"[DEBUG] Turning Start On Lid Open off!")
+            self.log.debug("Turning Start On Lid Open off!")
 
-        self.proxy.startOnLidOpen = state
-        self.proxy.Save()
+        self.setter.set("startOnLidOpen", state)
 
         return False
 
-parser = argparse.ArgumentParser(prog = "SamsungSettings", description = "A clone of Samsung Settings for Linux using the samsung-galaxybook kernel module.")
-parser.add_argument("-r", "--restore", action = "store_true", help = "Restores saved settings on module reload or a reboot.")
-parser.add_argument("-k", "--inckey", action = "store_true" , help = "Increments the keyboard backlight and wraps back around at 100 percent.")
-parser.add_argument("-u", "--uifile", required = False, type = pathlib.Path, help = "Sets the location for the UI file.")
-args = parser.parse_args()
-
-if args.restore:
-    # Restore
-    print(f"[DEBUG] [Main] Restoring settings then exiting!")
-    bus = pydbus.SystemBus()
-    proxy = bus.get("org.jordynsblog.SamsungSettingsDaemon", "/org/jordynsblog/SamsungSettingsDaemon")
-    if not proxy.moduleLoaded:
-        print(f"[ERROR] [Main] Cannot restore settings as samsung-galaxybook is not loaded or /sys/bus/platform/devices/samsung-galaxybook is otherwise missing!")
-        raise SystemExit(1)
-    proxy.Restore()
-    raise SystemExit(0)
-elif args.inckey:
-    bus = pydbus.SystemBus()
-    proxy = bus.get("org.jordynsblog.SamsungSettingsDaemon", "/org/jordynsblog/SamsungSettingsDaemon")
-
-    if proxy.kbdBacklight == 3:
-        proxy.kbdBacklight = 0
-    else:
-        proxy.kbdBacklight = proxy.kbdBacklight + 1
-
-    proxy.Save()
-else:
-    # run GTK
-    app = MyApp(uifile = args.uifile, application_id = "org.jordynsblog.SamsungSettings")
-    app.run([]) # We don't use GTK's argument parsing, so I'm passing it in a blank argv.
+# run GTK
+app = MyApp(uifile = args.uifile, application_id = "org.jordynsblog.SamsungSettings")
+app.run([]) # We don't use GTK's argument parsing, so I'm passing it in a blank argv.
@@ -6,11 +6,538 @@ from gi.repository import GLib, Gio
 import sys
 import argparse
 import os 
+import signal
+import time
+import errno
+import socket
+import bisect
+import logging
+import copy
+import stat
+import array
+import math
+import threading
+import functools
+import collections
+import concurrent.futures
 
 try:
     import sdnotify
 except ModuleNotFoundError:
-    print(f"[NOTE] Disabling systemd-notify support as sdnotify is not installed!")
+    pass
+
+try:
+    from systemd import journal
+except ModuleNotFoundError:
+    pass
+
+class RateLimitFilter(logging.Filter):
+    """ The RateLimitFilter() class stops a single log call from flooding the journal.
+
+    Every call site (file and line) may log up to burst messages per interval seconds, anything
+    past that is dropped and counted. Once the interval is over a summary says how many were
+    suppressed, from a timer in case the call site has gone quiet by then, so nothing disappears
+    without a trace. If the main loop isn't running to fire the timer, the next message from that
+    call site that gets through carries the count instead.
+    """
+
+    def __init__(self, burst = 10, interval = 5):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        # (pathname, lineno) -> [window start, messages logged in window, messages suppressed]
+        self.sites = {}
+
+    def filter(self, record):
+        now = time.monotonic()
+        site = self.sites.get((record.pathname, record.lineno))
+        if site is None or now - site[0] >= self.interval:
+            suppressed = 0
+            if site is not None:
+                suppressed, site[2] = site[2], 0
+            self.sites[(record.pathname, record.lineno)] = [now, 1, 0]
+            if suppressed:
+                record.msg = f"{record.msg} (suppressed {suppressed} similar messages)"
+            return True
+
+        if site[1] < self.burst:
+            site[1] += 1
+            return True
+
+        site[2] += 1
+        if site[2] == 1:
+            GLib.timeout_add(int((site[0] + self.interval - now) * 1000) + 1, self.handle_window_end, site, record)
+        return False
+
+    def handle_window_end(self, site, record):
+        if site[2]:
+            logging.getLogger(record.name).log(record.levelno, "Suppressed %s similar messages like: %s", site[2], record.getMessage())
+            site[2] = 0
+        return False
+
+class Metrics():
+    """ The Metrics() class collects timing histograms and counters about what the daemon is doing.
+
+    Timings go into fixed buckets (in microseconds), so recording one is a bisect and a couple
+    of additions no matter how long the daemon has been running. Everything is reported over
+    D-Bus by Daemon.GetStats() to help track down things like slow key presses.
+
+    Metrics are recorded from the worker threads as well, so everything happens under a lock.
+    """
+
+    # Upper bounds of the histogram buckets in microseconds, anything slower goes in an extra overflow bucket.
+    buckets = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000, 500000, 1000000, 2500000]
+
+    class Timer():
+        """ Context manager returned by Metrics.timed(). """
+
+        def __init__(self, metrics, name):
+            self.metrics = metrics
+            self.name = name
+
+        def __enter__(self):
+            self.started = time.perf_counter()
+            return self
+
+        def __exit__(self, exctype, excvalue, traceback):
+            self.metrics.observe(self.name, time.perf_counter() - self.started)
+            if exctype is not None:
+                self.metrics.count(f"{self.name}.errors")
+            return False
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, amount = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        usec = seconds * 1000000
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {"buckets": [0] * (len(self.buckets) + 1), "count": 0, "total": 0.0, "max": 0.0}
+
+            histogram["buckets"][bisect.bisect_left(self.buckets, usec)] += 1
+            histogram["count"] += 1
+            histogram["total"] += usec
+            histogram["max"] = max(histogram["max"], usec)
+
+    def timed(self, name):
+        """ timed() returns a context manager that records how long its block took under name. """
+        return self.Timer(self, name)
+
+    def percentile(self, histogram, percentile):
+        """ percentile() estimates a percentile as the upper bound of the bucket it falls in. """
+        wanted = histogram["count"] * percentile / 100
+        seen = 0
+        for index, count in enumerate(histogram["buckets"]):
+            seen += count
+            if count and seen >= wanted:
+                return self.buckets[index] if index < len(self.buckets) else histogram["max"]
+
+        return 0
+
+    def report(self):
+        """ report() returns all metrics as a dictonary that can be turned into JSON. """
+        with self.lock:
+            return self.__report__()
+
+    def __report__(self):
+        histograms = {}
+        for name, histogram in self.histograms.items():
+            histograms[name] = {
+                "count": histogram["count"],
+                "mean_us": histogram["total"] / histogram["count"],
+                "max_us": histogram["max"],
+                "p50_us": self.percentile(histogram, 50),
+                "p99_us": self.percentile(histogram, 99),
+                "buckets_us": {f"<={bound}": count for bound, count in zip(self.buckets + ["inf"], histogram["buckets"]) if count}
+            }
+
+        return {"uptime": time.monotonic() - self.started, "counters": dict(self.counters), "histograms": histograms}
+
+metrics = Metrics()
+
+class GSDPowerProxy():
+    """ The GSDPowerProxy() class caches the connection to gsd-power's keyboard backlight interface.
+
+    Connecting to the session bus and introspecting gsd-power used to happen on every single
+    backlight change (including every --inckey press), so now the proxy is created once and reused.
+
+    NameOwnerChanged is watched so the cached proxy is dropped when gsd-power exits or restarts,
+    and negative results are remembered as well: a missing gsd-power isn't retried until its name
+    shows up on the bus, and a missing session bus isn't retried until retrydelay seconds have passed.
+
+    get() is called from a worker thread while the signal handlers run in the main loop, so the
+    state is only touched under a lock. The lock is never held during a D-Bus call though, as the
+    main loop would then be stuck waiting for it.
+    """
+
+    log = logging.getLogger("GSDPowerProxy")
+
+    busname = "org.gnome.SettingsDaemon.Power"
+
+    def __init__(self, retrydelay = 60):
+        self.retrydelay = retrydelay
+        self.bus = None
+        self.busfailedat = None
+        self.keyboard = None
+        self.absent = False
+        self.lock = threading.Lock()
+
+    def get(self):
+        """ get() returns the cached keyboard interface proxy or None if gsd-power isn't usable right now. """
+        with self.lock:
+            if self.keyboard is not None:
+                return self.keyboard
+
+            if self.bus is None and self.busfailedat is not None and time.monotonic() - self.busfailedat < self.retrydelay:
+                return None
+
+            bus = self.bus
+
+        if bus is None:
+            try:
+                with metrics.timed("gsdpower.connect"):
+                    bus = pydbus.SessionBus()
+            except GLib.GError:
+                metrics.count("gsdpower.nosessionbus")
+                self.log.error("Cannot connect to the D-Bus session bus, not retrying for %s seconds!", self.retrydelay)
+                with self.lock:
+                    self.busfailedat = time.monotonic()
+                return None
+
+            # The shared session bus connection kills the process when it closes by default,
+            # which is not something a system daemon should do because a user logged out.
+            bus.con.set_exit_on_close(False)
+            bus.con.connect("closed", self.handle_bus_closed)
+            bus.subscribe(iface = "org.freedesktop.DBus", signal = "NameOwnerChanged", arg0 = self.busname, signal_fired = self.handle_name_owner_changed)
+            with self.lock:
+                self.bus = bus
+                self.busfailedat = None
+
+        with self.lock:
+            if self.absent:
+                return None
+
+        try:
+            with metrics.timed("gsdpower.introspect"):
+                keyboard = bus.get(self.busname)["org.gnome.SettingsDaemon.Power.Keyboard"]
+        except GLib.GError:
+            metrics.count("gsdpower.notrunning")
+            self.log.error("gsd-power is not running, using /sys until it shows up on the bus!")
+            with self.lock:
+                self.absent = True
+            return None
+
+        with self.lock:
+            self.keyboard = keyboard
+        return keyboard
+
+    def invalidate(self):
+        """ invalidate() drops the cached proxy so the next get() reconnects. """
+        with self.lock:
+            self.keyboard = None
+
+    def handle_name_owner_changed(self, sender, object, iface, signal, params):
+        name, oldowner, newowner = params
+        self.log.debug("%s owner changed from '%s' to '%s'!", name, oldowner, newowner)
+        with self.lock:
+            self.keyboard = None
+            self.absent = newowner == ""
+
+    def handle_bus_closed(self, connection, remotepeervanished, error):
+        self.log.debug("Session bus connection closed!")
+        with self.lock:
+            self.bus = None
+            self.keyboard = None
+            self.absent = False
+            self.busfailedat = time.monotonic()
+
+class SysfsAttribute():
+    """ The SysfsAttribute() class is a persistent handle to a single /sys attribute.
+
+    The file is opened once and kept open, and reads and writes use pread()/pwrite() at
+    offset 0 which is what sysfs expects, instead of opening and closing the file every time.
+
+    It also remembers the last value seen in hardware so writing the value the hardware
+    already holds is skipped entirely, along with whatever ACPI call the write would trigger.
+    That value is only trusted while SysfsWatcher() knows the attribute notifies on changes,
+    otherwise it's read again right before comparing.
+    If the handle goes stale because samsung-galaxybook was reloaded, it's reopened transparently.
+
+    Writes happen on a worker thread while reads happen in the main loop, and kernfs serializes
+    everything done through the same open file, so a slow write would hold up the main loop's
+    next read. The main loop therefore reads (and watches for POLLPRI) through a "read" handle of
+    it's own, while write() does everything, including the read it compares against, through a
+    separate "write" handle. Opening and closing the handles is done under a lock.
+    """
+
+    log = logging.getLogger("SysfsAttribute")
+
+    # errno values that mean our file descriptor points at a sysfs node that no longer exists.
+    staleerrors = [errno.ENODEV, errno.ENOENT, errno.ESTALE, errno.EBADF]
+
+    def __init__(self, path, elide = True, readonly = False):
+        self.path = pathlib.Path(path)
+        self.elide = elide
+        self.flags = {"read": os.O_RDONLY, "write": os.O_RDONLY if readonly else os.O_RDWR}
+        # handle -> file descriptor, opened the first time it's used
+        self.fds = {"read": None, "write": None}
+        self.value = None
+        # Set by SysfsWatcher() while every change to the attribute reaches us through POLLPRI.
+        self.notifying = False
+        self.lock = threading.Lock()
+
+    def open(self, handle = "read"):
+        with self.lock:
+            if self.fds[handle] is None:
+                self.fds[handle] = os.open(self.path, self.flags[handle] | os.O_CLOEXEC)
+
+            return self.fds[handle]
+
+    def close(self):
+        with self.lock:
+            for handle, fd in self.fds.items():
+                if fd is not None:
+                    os.close(fd)
+                    self.fds[handle] = None
+
+            # Whatever we knew about the old node doesn't apply to a new one.
+            self.value = None
+
+    def fileno(self):
+        return self.open("read")
+
+    def __io__(self, func, handle = "read"):
+        """ __io__() runs func with the handle's file descriptor, reopening it once if it went stale. """
+        try:
+            return func(self.open(handle))
+        except OSError as e:
+            if e.errno not in self.staleerrors:
+                raise
+
+        self.log.debug("Handle for %s went stale, reopening it!", self.path)
+        metrics.count("sysfs.reopen")
+        self.close()
+        return func(self.open(handle))
+
+    def read(self, handle = "read"):
+        """ read() returns the current value of the attribute as a stripped string. """
+        with metrics.timed(f"sysfs.read.{self.path.name}"):
+            self.value = self.__io__(lambda fd: os.pread(fd, 4096, 0), handle).decode().strip()
+        return self.value
+
+    def write(self, val):
+        """ write() writes val to the attribute unless the hardware already holds it.
+
+        Returns True if a write actually happened.
+        """
+        val = f"{val}"
+        if self.elide:
+            if self.value is None or not self.notifying:
+                self.read("write")
+
+            if self.value == val:
+                self.log.debug("%s is already %s, skipping write!", self.path, val)
+                metrics.count(f"sysfs.elided.{self.path.name}")
+                return False
+
+        with metrics.timed(f"sysfs.write.{self.path.name}"):
+            self.__io__(lambda fd: os.pwrite(fd, val.encode(), 0), "write")
+        self.value = val
+        return True
+
+class SysfsWatcher():
+    """ The SysfsWatcher() class watches SysfsAttribute() handles for changes made outside of the daemon.
+
+    inotify (and so Gio's file monitors) never fires for sysfs attributes, so instead every
+    attribute is registered with the GLib main loop for POLLPRI, which is what the kernel
+    raises when a driver calls sysfs_notify() on it. That gets changes to us as soon as they happen
+    without any wakeups while nothing is changing.
+
+    Not every attribute calls sysfs_notify() though, so attributes are also polled until they've
+    delivered a POLLPRI at least once. The polling interval starts at mininterval seconds and
+    doubles up to maxinterval while nothing changes, and polling stops entirely once every
+    attribute has proven it notifies.
+
+    The callback is called as callback(key, value) with the new value as a string. While paused,
+    attributes are still read so notifications are acknowledged, but the callback isn't called.
+    """
+
+    log = logging.getLogger("SysfsWatcher")
+
+    def __init__(self, attrs, callback, mininterval = 1, maxinterval = 30):
+        self.attrs = attrs
+        self.callback = callback
+        self.mininterval = mininterval
+        self.maxinterval = maxinterval
+        self.interval = mininterval
+        self.polltimer = None
+        self.paused = False
+
+        # key -> (fd, GLib source id) for attributes registered for POLLPRI
+        self.sources = {}
+
+        # keys that have delivered a POLLPRI and don't need polling anymore
+        self.notifying = set()
+
+    def start(self):
+        for key in self.attrs:
+            self.arm(key)
+
+        self.schedule_poll()
+
+    def arm(self, key):
+        """ arm() (re)registers the attribute's current handle for POLLPRI. """
+        attr = self.attrs[key]
+        try:
+            # Reading the attribute is also what acknowledges the previous notification.
+            attr.read()
+            fd = attr.fileno()
+        except OSError:
+            self.disarm(key)
+            return
+
+        if key in self.sources:
+            if self.sources[key][0] == fd:
+                return
+            self.disarm(key)
+
+        sourceid = GLib.unix_fd_add_full(GLib.PRIORITY_DEFAULT, fd, GLib.IOCondition.PRI | GLib.IOCondition.ERR, self.handle_notify, key)
+        self.sources[key] = (fd, sourceid)
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    def disarm(self, key):
+        if key in self.sources:
+            GLib.source_remove(self.sources.pop(key)[1])
+        self.notifying.discard(key)
+        self.attrs[key].notifying = False
+
+    def check(self, key):
+        """ check() rereads the attribute and calls the callback if it changed. Returns True if it did. """
+        attr = self.attrs[key]
+        oldval = attr.value
+        try:
+            newval = attr.read()
+        except OSError:
+            self.log.debug("%s went away, polling for it instead!", attr.path)
+            self.disarm(key)
+            return False
+
+        if newval == oldval or self.paused:
+            return False
+
+        self.callback(key, newval)
+        return True
+
+    def handle_notify(self, fd, condition, key):
+        metrics.count("watcher.notify")
+        if key not in self.notifying:
+            self.log.debug("%s supports sysfs_notify, no longer polling it!", self.attrs[key].path)
+            self.notifying.add(key)
+            self.attrs[key].notifying = True
+
+        self.check(key)
+
+        # The handle may have been reopened or dropped while reading it, in which
+        # case the new one (if any) gets registered and this source goes away.
+        if self.sources.get(key, (None, None))[0] != fd:
+            self.sources.pop(key, None)
+            self.arm(key)
+            self.schedule_poll()
+            return False
+
+        return True
+
+    def schedule_poll(self):
+        if self.polltimer is not None:
+            return
+
+        if all(key in self.notifying for key in self.attrs):
+            return
+
+        # timeout_add_seconds lets GLib batch our wakeups together with everyone else's.
+        self.polltimer = GLib.timeout_add_seconds(self.interval, self.handle_poll)
+
+    def handle_poll(self):
+        self.polltimer = None
+        metrics.count("watcher.poll")
+        changed = False
+        for key in self.attrs:
+            if key in self.notifying:
+                continue
+
+            if key not in self.sources:
+                self.arm(key)
+            elif self.check(key):
+                changed = True
+
+        # Back off while things are quiet, but react quickly again once they aren't.
+        if changed:
+            self.interval = self.mininterval
+        else:
+            self.interval = min(self.interval * 2, self.maxinterval)
+
+        self.schedule_poll()
+        return False
+
+class SettingDescriptor():
+    """ The SettingDescriptor() class describes a single setting and the /sys attribute behind it.
+
+    Settings() keeps a table of these instead of code for each setting, and validation, the D-Bus
+    properties and introspection and /sys change handling are all generated from that table.
+
+    path is relative to the sysfs root and can be a glob, in which case the first match is used.
+    dbustype is the property's D-Bus type, "b" for switches or "n"/"i" for numbers between minimum
+    and maximum (None means no limit). If maxpath is given the maximum is read from that attribute,
+    next to path, instead. writer names a Settings() method that applies the setting instead of a
+    plain write to /sys. A default of None means whatever the hardware holds at startup.
+
+    Required settings are always published so clients can count on them, even without the module
+    loaded. Anything else is only published if the machine actually has the attribute.
+    """
+
+    def __init__(self, name, path, dbustype, default = None, minimum = None, maximum = None, maxpath = None, writer = None, required = False):
+        self.name = name
+        self.path = path
+        self.dbustype = dbustype
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum
+        self.maxpath = maxpath
+        self.writer = writer
+        self.required = required
+
+        # The attribute this resolved to, filled in by Settings.Scan()
+        self.file = None
+
+    def validate(self, val):
+        """ validate() raises a ValueError if val isn't a valid value for this setting. """
+        if self.dbustype == "b":
+            if val not in [0, 1, False, True]:
+                raise ValueError(f"{self.name} must be an integer or a boolean!")
+            return
+
+        if not isinstance(val, (int, float)) or int(val) != val:
+            raise ValueError(f"{self.name} must be an integer!")
+
+        if (self.minimum is not None and val < self.minimum) or (self.maximum is not None and val > self.maximum):
+            raise ValueError(f"{self.name} must be in between {self.minimum}-{self.maximum}!")
+
+    def convert(self, val):
+        """ convert() returns val as the type the setting is stored and published as. """
+        return bool(val) if self.dbustype == "b" else int(val)
 
 class Settings():
     """ The Settings() class is a high level class that implements the actual logic in SamsungSettings.
@@ -19,162 +546,522 @@ class Settings():
     for restoration on boot and it handles the actual setting of the settings using
     either the /sys filesystem entries or other daemons via D-Bus (mainly the gsd-power daemon as of now).
 
+    Which settings exist is decided once at startup by Scan(), which checks the registry below
+    against the sysfs tree and also picks up any unknown writable attributes the module exposes.
+
     It's only really used in the Daemon() class below for logical seperation of functionality
     and to avoid a monster class.
 
     """
 
-    # Directory containing path to kernel tunables for samsung-galaxybook module
+    log = logging.getLogger("Settings")
+
+    # Paths for the samsung-galaxybook module, relative to the root of the sysfs tree so the
+    # daemon can be pointed at a fake one for development and benchmarking.
+    syslayout = {
+        "base": "sys/bus/platform/devices/samsung-galaxybook"
+    }
+    sysroot = pathlib.Path("/")
+    sysfiles = {key: pathlib.Path("/", path) for key, path in syslayout.items()}
+
+    # Every setting the daemon knows about.
     # NB: these won't work unless we're running as root or the user configured
     # their permissions correctly.
-    sysfiles = {"base": pathlib.Path("/sys/bus/platform/devices/samsung-galaxybook")}
-    sysfiles.update({
-        "usbchg": sysfiles["base"] / "usb_charging",
-        "perfmode": sysfiles["base"] / "performance_mode",
-        "kbdbacklight": pathlib.Path("/sys/class/leds/samsung-galaxybook::kbd_backlight/brightness"),
-        "batterySaver": sysfiles["base"] / "battery_saver",
-        "startOnLidOpen": sysfiles["base"] / "start_on_lid_open"
-    })
-
-    settings = {
-        "usbCharging": False,
-        "perfMode": 0,
-        "kbdBacklight": 0,
-        "batterySaver": False,
-        "startOnLidOpen": False
+    registry = [
+        SettingDescriptor("usbCharging", "sys/bus/platform/devices/samsung-galaxybook/usb_charging", "b", False, required = True),
+        SettingDescriptor("perfMode", "sys/bus/platform/devices/samsung-galaxybook/performance_mode", "n", 0, 0, 3, required = True),
+        SettingDescriptor("kbdBacklight", "sys/class/leds/samsung-galaxybook::kbd_backlight/brightness", "n", 0, 0, 3, maxpath = "max_brightness", writer = "setKeyboardBacklight", required = True),
+        SettingDescriptor("batterySaver", "sys/bus/platform/devices/samsung-galaxybook/battery_saver", "b", False, required = True),
+        SettingDescriptor("startOnLidOpen", "sys/bus/platform/devices/samsung-galaxybook/start_on_lid_open", "b", False, required = True),
+        SettingDescriptor("chargeEndThreshold", "sys/class/power_supply/BAT*/charge_control_end_threshold", "n", None, 1, 100)
+    ]
+
+    # Files in the module's directory that are never settings, even though some of them are writable.
+    ignoredattrs = ["uevent", "modalias", "driver_override", "driver", "subsystem", "power"]
+
+    settings = {}
+
+    # Built in performance profiles, profiles.json next to the settings file can
+    # change these or add new ones. Profiles only need to list the settings they change.
+    profiles = {
+        "battery": {"perfMode": 0, "batterySaver": True, "kbdBacklight": 0},
+        "balanced": {"perfMode": 2, "batterySaver": False},
+        "max": {"perfMode": 3, "batterySaver": False}
     }
 
-    def IsModuleLoaded(self):
-        return self.sysfiles["base"].exists()
+    def __init__(self, file = "settings.json", savedelay = 2000, elide = True, gsdpower = True):
+        # The settings this machine supports, by name. Unsupported ones don't get a handle,
+        # a watch or a property, so they cost nothing past the initial scan.
+        self.capabilities = self.Scan()
 
-    def Save(self, file = "settings.json"):
-        print(f"[DEBUG] [Settings]: Saving settings to {file}")
-        with open(file, "w") as fileh:
-            json.dump(self.settings, fileh)
+        # Every instance gets it's own dictonary, starting out with the defaults.
+        self.settings = {name: descriptor.default for name, descriptor in self.capabilities.items()}
+        self.file = file
 
-    def Load(self, file = "settings.json"):
-        print(f"[DEBUG] [Settings]: Loading settings from {file}")
-        with open(file, "r") as fileh:
-            settings = json.load(fileh)
+        # Persistent handles for every attribute we touch. Write elision relies on the cached
+        # hardware values being kept up to date by the /sys watch, so it's only on when that's running.
+        self.attrs = {name: SysfsAttribute(descriptor.file, elide) for name, descriptor in self.capabilities.items()}
+
+        # Saving is write-behind: Save() only marks the settings as dirty and the actual
+        # write happens once savedelay milliseconds have passed, so bursts of changes
+        # (slider drags, key repeat, /sys event storms) end up as a single write.
+        self.savedelay = savedelay
+        self.dirty = False
+        self.savetimer = None
+        self.savestats = {"requested": 0, "written": 0, "coalesced": 0, "forced": 0}
 
-            # The settings dictonary is being loaded in this weird way so values that exist in the default dictonary
-            # aren't removed from loading an older settings file.
-            for key in settings:
-                self.settings.update({key: settings[key]})
+        # Without gsd-power the keyboard backlight is written straight to /sys. The oneshot
+        # --restore runs as root at boot, where even looking for a session bus may autolaunch one.
+        self.gsdpower = GSDPowerProxy() if gsdpower else None
 
-    def Restore(self, file = "settings.json"):
-        print(f"[DEBUG] [Settings]: Restoring settings from {file}")
-        self.Load(file)
-        self.setUSBCharging(self.settings["usbCharging"])
-        self.setPerfMode(self.settings["perfMode"])
-        self.setKeyboardBacklight(self.settings["kbdBacklight"])
-        self.setBatterySaver(self.settings["batterySaver"])
-        self.setStartOnLidOpen(self.settings["startOnLidOpen"])
+        # The WorkerPool() slow writes are handed to, if there is one. Without one everything
+        # is done right away, which is what the oneshot --restore wants.
+        self.workers = None
+
+        self.profiles = dict(self.profiles)
+        self.profilesfile = pathlib.Path(file).parent / "profiles.json"
+
+    @classmethod
+    def SetSysfsRoot(cls, root):
+        """ SetSysfsRoot() points every path in sysfiles at a different sysfs tree.
+
+        This has to be called before any Settings() instances are created.
+        """
+        cls.sysroot = pathlib.Path(root)
+        cls.sysfiles = {key: cls.sysroot / path for key, path in cls.syslayout.items()}
+
+    @staticmethod
+    def attributeName(filename):
+        """ attributeName() turns an attribute's file name into a setting name, like charge_type -> chargeType. """
+        first, *rest = filename.replace("-", "_").split("_")
+        return first + "".join(word.capitalize() for word in rest)
+
+    def Scan(self):
+        """ Scan() builds the capability index, the settings this machine actually has.
+
+        Registry entries whose attribute is missing are left out unless they're required. After that,
+        any integer attribute in the module's directory that's writable but not in the registry is
+        published too (as an "i" with no range, the kernel checks the values), so settings added
+        to the module later show up without changes here.
+        """
+        capabilities = {}
+        known = set()
+        for entry in self.registry:
+            matches = sorted(self.sysroot.glob(entry.path))
+            if not matches and not entry.required:
+                self.log.debug("%s is not supported here, skipping it!", entry.name)
+                continue
+
+            # The registry is shared, so anything learned from this machine goes into a copy.
+            descriptor = copy.copy(entry)
+            descriptor.file = matches[0] if matches else self.sysroot / entry.path
+            known.add(descriptor.file)
+            try:
+                if descriptor.maxpath is not None:
+                    descriptor.maximum = int((descriptor.file.parent / descriptor.maxpath).read_text())
+                if descriptor.default is None:
+                    descriptor.default = descriptor.convert(int(descriptor.file.read_text()))
+            except (OSError, ValueError) as e:
+                if not descriptor.required:
+                    self.log.warning("Cannot read %s (%s), skipping it!", descriptor.file, e)
+                    continue
+
+            capabilities[descriptor.name] = descriptor
+
+        base = self.sysfiles["base"]
+        if not base.is_dir():
+            return capabilities
+
+        for file in sorted(base.iterdir()):
+            if file in known or file.name in self.ignoredattrs or file.is_symlink() or not file.is_file():
+                continue
+
+            name = self.attributeName(file.name)
+            try:
+                if name in capabilities or not file.stat().st_mode & stat.S_IWUSR:
+                    continue
+                value = int(file.read_text())
+            except (OSError, ValueError):
+                continue
 
-    def getUSBCharging(self):
-        return self.settings["usbCharging"]
+            self.log.info("Found unknown attribute %s, publishing it as %s!", file.name, name)
+            descriptor = SettingDescriptor(name, str(file.relative_to(self.sysroot)), "i", value)
+            descriptor.file = file
+            capabilities[name] = descriptor
 
-    def getPerfMode(self):
-        return self.settings["perfMode"]
+        return capabilities
 
-    def getKeyboardBacklight(self):
-        return self.settings["kbdBacklight"]
+    def IsModuleLoaded(self):
+        return self.sysfiles["base"].exists()
 
-    def getBatterySaver(self):
-        return self.settings["batterySaver"]
+    def Save(self, file = None, force = False):
+        """ Save() requests that the settings are written to the settings file.
+
+        Unless force is True or the save delay is disabled, the write is deferred
+        and merged with any other Save() calls that come in before it happens.
+        """
+        if file is not None:
+            self.file = file
+
+        self.savestats["requested"] += 1
+        if self.dirty:
+            self.savestats["coalesced"] += 1
+        self.dirty = True
+
+        if force or self.savedelay <= 0:
+            self.Flush(force)
+        elif self.savetimer is None:
+            self.savetimer = GLib.timeout_add(self.savedelay, self.handle_save_timer)
+
+    def handle_save_timer(self):
+        self.savetimer = None
+        self.Flush()
+        return False
+
+    def Flush(self, force = False):
+        """ Flush() writes the settings file now if there are unsaved changes.
+
+        The file is written to a temporary file and renamed over the old one so it's never
+        left half written. Forced flushes, which only happen at shutdown, are also fsync'd.
+
+        If there's a worker pool, the settings are serialized right away but written by a
+        worker, unless the flush is forced, which means the caller needs it on disk before
+        going on. Callers forcing a flush have to drain the pool first.
+        """
+        if self.savetimer is not None:
+            GLib.source_remove(self.savetimer)
+            self.savetimer = None
+
+        if not self.dirty:
+            return
 
-    def getStartOnLidOpen(self):
-        return self.settings["startOnLidOpen"]
+        path = pathlib.Path(self.file)
+        data = json.dumps(self.settings)
+        self.log.debug("Saving settings to %s (%s of %s saves coalesced so far)", path, self.savestats['coalesced'], self.savestats['requested'])
+        self.dirty = False
+        self.savestats["written"] += 1
+        if force:
+            self.savestats["forced"] += 1
 
-    def setUSBCharging(self, val):
-        print(f"[DEBUG] [Settings]: Setting USB Charging to {val}!")
+        if self.workers is None or force:
+            self.writeFile(path, data, force)
+        else:
+            self.workers.submit(path, functools.partial(self.writeFile, path, data, force), self.handle_file_written)
+
+    def writeFile(self, path, data, force):
+        tmppath = path.with_name(f".{path.name}.tmp")
+        with metrics.timed("settings.save.forced" if force else "settings.save"):
+            with open(tmppath, "w") as fileh:
+                fileh.write(data)
+                if force:
+                    fileh.flush()
+                    os.fsync(fileh.fileno())
+            os.replace(tmppath, path)
+
+            if force:
+                # The rename itself only survives a power cut once the directory is synced too.
+                dirfd = os.open(path.parent, os.O_RDONLY)
+                try:
+                    os.fsync(dirfd)
+                finally:
+                    os.close(dirfd)
+
+    def handle_file_written(self, result, error):
+        if error is not None:
+            self.log.error("Failed to save settings to %s: %s", self.file, error)
+            # Try again with the next save.
+            self.dirty = True
+
+    def Read(self, file = None):
+        """ Read() returns the settings saved in the settings file without loading them. """
+        file = file or self.file
+        with open(file, "r") as fileh:
+            return json.load(fileh)
+
+    def Load(self, file = None):
+        file = file or self.file
+        self.log.debug("Loading settings from %s", file)
+        settings = self.Read(file)
+
+        # The settings dictonary is being loaded in this weird way so values that exist in the default dictonary
+        # aren't removed from loading an older settings file.
+        for key in settings:
+            self.settings.update({key: settings[key]})
+
+    def Restore(self, file = None):
+        file = file or self.file
+        self.log.debug("Restoring settings from %s", file)
+        with metrics.timed("settings.restore"):
+            self.Load(file)
+            for key in self.capabilities:
+                try:
+                    self.Set(key, self.settings[key])
+                except ValueError as e:
+                    self.log.error("Not restoring %s: %s", key, e)
+
+    def Adopt(self, file = None):
+        """ Adopt() loads the settings file, then takes over whatever the hardware holds right now.
+
+        This is what an on-demand start uses instead of Restore(): the saved settings were already
+        restored at boot, and anything changed since then while the daemon wasn't running to see
+        it should be kept and saved instead of undone.
+        """
         try:
-            self.sysfiles["usbchg"].write_text(f"{val}")
+            self.Load(file)
         except FileNotFoundError:
-            print(f"[ERROR] {self.sysfiles['usbchg']} was not found! is samsung-galaxybook loaded???")
-
-        # I put this here instead of in the above exception block so that the user
-        # can change settings if they don't have the module loaded and it'll
-        # still be saved to the settings file.
-        self.settings["usbCharging"] = val
-    
-    def setPerfMode(self, val):
-        print(f"[DEBUG] [Settings]: Setting Performance Mode to {val}!")
-        if val not in [0, 1, 2, 3]:
-            raise ValueError("Performance Mode value cannot be less than 0 or more than 3!")
-            
+            self.log.debug("%s not found!", file or self.file)
+
+        changed = False
+        for key, descriptor in self.capabilities.items():
+            try:
+                current = descriptor.convert(int(self.attrs[key].read()))
+            except (OSError, ValueError):
+                continue
+
+            if current != self.settings[key]:
+                self.log.info("%s changed to %s while we weren't running!", key, current)
+                self.settings[key] = current
+                changed = True
+
+        if changed:
+            self.Save()
+
+    def LoadProfiles(self, file = None):
+        """ LoadProfiles() loads profiles.json on top of the built in profiles.
+
+        Every profile is validated and converted to integers here, once, so applying
+        one later is nothing more than a comparison against the hardware.
+        """
+        file = pathlib.Path(file or self.profilesfile)
+        profiles = dict(type(self).profiles)
+        if file.exists():
+            self.log.debug("Loading profiles from %s", file)
+            with open(file, "r") as fileh:
+                profiles.update(json.load(fileh))
+
+        self.profiles = {}
+        for name, values in profiles.items():
+            try:
+                for key in values:
+                    self.Validate(key, values[key])
+            except ValueError as e:
+                self.log.error("Ignoring profile %s: %s", name, e)
+                continue
+
+            self.profiles[name] = {key: int(values[key]) for key in values}
+
+    def Diff(self, values):
+        """ Diff() returns the part of values that differs from what the hardware currently holds.
+
+        If an attribute can't be read (no module, gsd-power only backlight), the saved setting is used instead.
+        """
+        changed = {}
+        for key in values:
+            try:
+                current = int(self.attrs[key].read())
+            except (OSError, ValueError):
+                current = int(self.settings[key])
+
+            if current != int(values[key]):
+                changed[key] = values[key]
+
+        return changed
+
+    def Validate(self, key, val):
+        """ Validate() checks a single setting value without applying it.
+
+        It raises a ValueError if the key is unknown or the value is out of range
+        for that setting, so callers can check a whole batch before touching /sys.
+        """
+        if key not in self.capabilities:
+            raise ValueError(f"Unknown setting {key}!")
+
+        self.capabilities[key].validate(val)
+
+    def Set(self, key, val):
+        """ Set() applies a single setting and records it in the settings. """
+        # I don't only record it if Write() succeeds so that the user can change
+        # settings if they don't have the module loaded and it'll still be saved
+        # to the settings file.
+        self.settings[key] = self.Write(key, val)
+
+    def Write(self, key, val):
+        """ Write() applies a single setting to the hardware, using it's writer if it has one and /sys otherwise.
+
+        It returns the value the way it's recorded, but doesn't record it itself, so it can be run
+        on a worker thread as long as only one runs for each setting at a time.
+        """
+        self.Validate(key, val)
+        descriptor = self.capabilities[key]
+        val = descriptor.convert(val)
+        if descriptor.writer is not None:
+            getattr(self, descriptor.writer)(val)
+            return val
+
+        self.log.debug("Setting %s to %s!", key, val)
         try:
-            self.sysfiles["perfmode"].write_text(f"{val}")
+            # Convert value to integer for writing to /sys, booleans are written as 0 or 1.
+            self.attrs[key].write(int(val))
         except FileNotFoundError:
-            print(f"[ERROR] {self.sysfiles['perfmode']} was not found! is samsung-galaxybook loaded???")
+            self.log.error("%s was not found! is samsung-galaxybook loaded???", self.attrs[key].path)
 
-        self.settings["perfMode"] = val
+        return val
 
     def setKeyboardBacklight(self, val):
-        print(f"[DEBUG] [Settings]: Setting keyboard backlight to {val}!")
-        if val < 0 or val > 3:
-            raise ValueError("Backlight value must be in between 0-3!")
+        self.log.debug("Setting keyboard backlight to %s!", val)
 
         def method_1(self, val):
+            if self.gsdpower is None:
+                return False
+
+            keyboard = self.gsdpower.get()
+            if keyboard is None:
+                return False
+
             try:
-                bus = pydbus.SessionBus()
-                powermethod = bus.get("org.gnome.SettingsDaemon.Power")
-                keyboardmethod = powermethod.__getitem__("org.gnome.SettingsDaemon.Power.Keyboard") # TODO: don't use __getitem__
-                keyboardmethod.Brightness = val
-            finally:
-                self.settings["kbdBacklight"] = val
+                with metrics.timed("gsdpower.set"):
+                    keyboard.Brightness = val
+                # gsd-power writes /sys behind our back, so we no longer know what it holds.
+                self.attrs["kbdBacklight"].value = None
+            except GLib.GError:
+                # gsd-power probably went away in between calls, so reconnect next time.
+                self.gsdpower.invalidate()
+                raise
+
+            return True
 
         def method_2(self, val):
-            try:
-                self.sysfiles["kbdbacklight"].write_text(f"{val}")
-            finally:
-                self.settings["kbdBacklight"] = val
+            self.attrs["kbdBacklight"].write(val)
 
         try:
-            print(f"[DEBUG] [Settings]: Using Method 1 -- gsd-power over D-Bus")
-            method_1(self, val)
-            return
+            self.log.debug("Using Method 1 -- gsd-power over D-Bus")
+            if method_1(self, val):
+                return
         except GLib.GError:
-            print(f"[ERROR] [Settings]: GError exception occured during keyboard backlight changing... either gsd-power is not running or a connection to the D-Bus session bus cannot be obtained!")
+            metrics.count("gsdpower.errors")
+            self.log.error("GError exception occured during keyboard backlight changing... either gsd-power is not running or a connection to the D-Bus session bus cannot be obtained!")
 
         try:
-            print(f"[DEBUG] [Settings]: Using Method 2 -- /sys")
+            self.log.debug("Using Method 2 -- /sys")
+            metrics.count("kbdbacklight.sysfsfallback")
             method_2(self, val)
             return
         except FileNotFoundError:
-            print(f"[ERROR] {self.sysfiles['kbdbacklight']} was not found! is samsung-galaxybook loaded???")
+            self.log.error("%s was not found! is samsung-galaxybook loaded???", self.attrs['kbdBacklight'].path)
 
-    def setBatterySaver(self, val):
-        if val not in [0, 1, False, True]:
-            raise ValueError("Battery Saver setting must be an integer or a boolean!")
+class WorkerPool():
+    """ The WorkerPool() class runs blocking work on a few worker threads instead of the main loop.
 
-        # Convert value to integer for writing to /sys.
-        # This will either keep the value if it's already an integer
-        # or convert a boolean to an integer representation.
-        val = int(val)
-        print(f"[DEBUG] [Settings]: Setting battery saver to {val}!")
-        try:
-            self.sysfiles["batterySaver"].write_text(f"{val}")
-        except FileNotFoundError:
-            print(f"[ERROR] {self.sysfiles['batterySaver']} was not found! is samsung-galaxybook loaded???")
+    Writes to /sys can block in ACPI firmware calls, gsd-power calls can block for the whole D-Bus
+    timeout and saving settings.json blocks on the disk. Running them here means a slow one only
+    holds up the work that has to wait for it, instead of every client and the watchdog.
+
+    Jobs are submitted under a key (a setting or a file) and jobs with the same key run one at a time,
+    in the order they were submitted, while jobs with different keys run in parallel. There should be
+    a worker for every key, so a key whose jobs are stuck (a gsd-power timeout, a hung ACPI call)
+    can't take a worker the others need. Threads are only started as they're needed. Once a job is
+    done its callback is called back in the main loop as callback(result, error), so everything
+    that touches the daemon's state or emits signals still happens there.
+    """
 
-        self.settings["batterySaver"] = val
+    log = logging.getLogger("WorkerPool")
 
-    def setStartOnLidOpen(self, val):
-        print(f"[DEBUG] [Settings]: Setting Start on Lid Open to {val}!")
-        if val not in [0, 1, False, True]:
-            raise ValueError("Start on Lid Open setting must be an integer or a boolean!")
+    def __init__(self, workers = 2):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = workers, thread_name_prefix = "worker")
 
-        # Convert value to integer for writing to /sys.
-        # This will either keep the value if it's already an integer
-        # or convert a boolean to an integer representation.
-        val = int(val)
-        try:
-            self.sysfiles["startOnLidOpen"].write_text(f"{val}")
-        except FileNotFoundError:
-            print(f"[ERROR] {self.sysfiles['startOnLidOpen']} was not found! is samsung-galaxybook loaded???")
+        # key -> deque of (func, callback) that haven't finished, the first one is running.
+        # This is only ever touched by the main loop.
+        self.queues = {}
+
+    def submit(self, key, func, callback = None):
+        queue = self.queues.setdefault(key, collections.deque())
+        queue.append((func, callback))
+        if len(queue) == 1:
+            self.run(key)
+
+    def busy(self, key):
+        """ busy() returns whether there are jobs for key that haven't finished. """
+        return key in self.queues
+
+    def run(self, key):
+        func, callback = self.queues[key][0]
+        future = self.executor.submit(func)
+        # The done callback runs on the worker, idle_add() is how it gets back to the main loop.
+        future.add_done_callback(lambda future: GLib.idle_add(self.handle_done, key, future, priority = GLib.PRIORITY_HIGH_IDLE))
+
+    def handle_done(self, key, future):
+        func, callback = self.queues[key].popleft()
+        if self.queues[key]:
+            self.run(key)
+        else:
+            del self.queues[key]
+
+        error = future.exception()
+        if callback is not None:
+            callback(None if error else future.result(), error)
+        elif error is not None:
+            self.log.error("Background job for %s failed: %s", key, error)
+
+        return False
+
+    def drain(self):
+        """ drain() runs the main loop until every job has finished and it's callback has been called. """
+        context = GLib.MainContext.default()
+        while self.queues:
+            context.iteration(True)
 
-        self.settings["startOnLidOpen"] = val
+class WriteQueue():
+    """ The WriteQueue() class collapses queued setting changes so only the newest value of each gets written.
+
+    Changes are applied from a low priority idle callback, which GLib only runs once every D-Bus call
+    that's already waiting has been dispatched. So a burst of calls for the same setting (like dragging
+    the backlight slider) collapses into a single write of the last value instead of one write each.
+
+    apply is called as apply(values, persist) with the collapsed changes.
+    """
+
+    log = logging.getLogger("WriteQueue")
+
+    def __init__(self, apply):
+        self.apply = apply
+        self.pending = {}
+        self.persist = False
+        self.idle = None
+
+    def queue(self, values, persist = False):
+        collapsed = len([key for key in values if key in self.pending])
+        if collapsed:
+            self.log.debug("Collapsing %s queued write(s)!", collapsed)
+            metrics.count("writequeue.collapsed", collapsed)
+
+        self.pending.update(values)
+        self.persist = self.persist or persist
+        if self.idle is None:
+            self.idle = GLib.idle_add(self.handle_idle, priority = GLib.PRIORITY_LOW)
+
+    def get(self, key, default):
+        """ get() returns the queued value for key if there is one, otherwise default. """
+        return self.pending.get(key, default)
+
+    def discard(self, key):
+        """ discard() drops the queued value for key, if there is one. """
+        self.pending.pop(key, None)
+
+    def handle_idle(self):
+        self.idle = None
+        self.flush()
+        return False
+
+    def flush(self):
+        """ flush() applies everything that's queued right now. """
+        if self.idle is not None:
+            GLib.source_remove(self.idle)
+            self.idle = None
+
+        values, persist = self.pending, self.persist
+        self.pending, self.persist = {}, False
+        if values or persist:
+            self.apply(values, persist)
 
 class Daemon():
     """ The Daemon() class is responsible for the high level funcionality of the SamsungSettings daemon.
@@ -185,12 +1072,15 @@ class Daemon():
     It also handles syncing the /sys filesystem entries to the saved settings file when other applications
     modify them, as gsd-power does when the keyboard backlight is changed from within GNOME.
 
-    And for systemd users, it also pings the service manager using the sdnotify protocol once 
-    everything is ready and every second or so for watchdog support.
+    And for systemd users, it also tells the service manager (using the Watchdog() class below) once
+    everything is ready and keeps it updated on what it's doing.
     """
 
+    log = logging.getLogger("Daemon")
+
     # I'm putting the D-Bus definitions in here as it's one less file I have to install.
-    dbus = """
+    # The properties for the settings are filled in by generateInterface() from the capability index.
+    dbustemplate = """
         <node>
             <interface name="org.jordynsblog.SamsungSettingsDaemon">
             <method name="Save">
@@ -202,209 +1092,1122 @@ class Daemon():
             <method name="Restore">
                 <arg type="s" name="response" direction="out"/>
             </method>
+            <method name="GetStats">
+                <arg type="s" name="stats" direction="out"/>
+            </method>
+            <method name="GetTelemetry">
+                <arg type="d" name="since" direction="in"/>
+                <arg type="d" name="until" direction="in"/>
+                <arg type="u" name="maxpoints" direction="in"/>
+                <arg type="as" name="channels" direction="out"/>
+                <arg type="ad" name="timestamps" direction="out"/>
+                <arg type="aad" name="values" direction="out"/>
+            </method>
+            <method name="SetMany">
+                <arg type="a{sv}" name="values" direction="in"/>
+                <arg type="b" name="persist" direction="in"/>
+                <arg type="s" name="response" direction="out"/>
+            </method>
+            <method name="ApplyProfile">
+                <arg type="s" name="name" direction="in"/>
+                <arg type="s" name="response" direction="out"/>
+            </method>
+            <method name="GetProfiles">
+                <arg type="as" name="names" direction="out"/>
+            </method>
+            <method name="StepKeyboardBacklight">
+                <arg type="n" name="step" direction="in"/>
+                <arg type="b" name="wrap" direction="in"/>
+                <arg type="n" name="value" direction="out"/>
+            </method>
+            <method name="CycleKeyboardBacklight">
+                <arg type="n" name="value" direction="out"/>
+            </method>
+            <method name="StepPerfMode">
+                <arg type="n" name="step" direction="in"/>
+                <arg type="b" name="wrap" direction="in"/>
+                <arg type="n" name="value" direction="out"/>
+            </method>
+            <method name="CyclePerfMode">
+                <arg type="n" name="value" direction="out"/>
+            </method>
+            <signal name="WriteFailed">
+                <arg type="s" name="key"/>
+                <arg type="v" name="value"/>
+                <arg type="s" name="error"/>
+            </signal>
             <property name="moduleLoaded" type="b" access="read">
                 <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
             </property>
-            <property name="usbCharging" type="b" access="readwrite">
-                <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
-            </property>
-            <property name="perfMode" type="n" access="readwrite">
-                <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
-            </property>
-            <property name="kbdBacklight" type="n" access="readwrite">
-                <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
-            </property>
-            <property name="batterySaver" type="b" access="readwrite">
-                <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
-            </property>
-            <property name="startOnLidOpen" type="b" access="readwrite">
-                <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
-            </property>
+            <!-- settings -->
             </interface>
         </node>"""
 
+    dbusproperty = """
+            <property name="{name}" type="{type}" access="readwrite">
+                <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
+            </property>"""
+
     PropertiesChanged = pydbus.generic.signal()
 
-    def __init__(self):
-        self.settings = Settings()
-        try:
-            self.settings.Restore()
-        except FileNotFoundError:
-            print(f"[DEBUG] settings.json not found!")
+    # Sent when writing a value failed, so clients waiting for that value to come back stop waiting.
+    WriteFailed = pydbus.generic.signal()
 
-        self.ignoresyschanges = False
+    def __new__(cls, settings, restore = True):
+        # Every daemon gets it's own subclass with the properties for it's own capabilities.
+        return super().__new__(cls.generateInterface(settings.capabilities))
 
-    def handle_file_change(self, monitor, file1, file2, evt_type):
-        if evt_type != Gio.FileMonitorEvent.CHANGED:
-            print("handle_file_change called with unneeded event... skipping!")
-            return
+    def __init__(self, settings, restore = True):
+        self.settings = settings
+        if restore:
+            try:
+                self.settings.Restore()
+            except FileNotFoundError:
+                self.log.debug("%s not found!", self.settings.file)
+        else:
+            self.settings.Adopt()
 
-        # File2 is only used during a move which cannot happen on /sys filesystems.
-        path = file1.get_path()
+        try:
+            self.settings.LoadProfiles()
+        except (OSError, ValueError) as e:
+            self.log.error("Failed to load %s: %s", self.settings.profilesfile, e)
+
+        self.watchdog = None
+        self.telemetry = None
+
+        # Every change to a setting goes through this queue so bursts collapse.
+        self.writequeue = WriteQueue(self.applySettings)
+
+        # The queued changes are written by the worker pool, and settings.json is saved there too,
+        # so there's a worker for every setting and one for saving.
+        self.workers = WorkerPool(len(settings.capabilities) + 1)
+        self.settings.workers = self.workers
+
+        # key -> values handed to the worker pool that haven't been written yet, oldest first
+        self.inflight = {}
+
+    @classmethod
+    def generateInterface(cls, capabilities):
+        """ generateInterface() returns a subclass of cls with a read/write property for every setting in the capability index.
+
+        pydbus reads the introspection data from the object's class when it's published, but the
+        capabilities are only known once the sysfs tree has been scanned. So instead of changing
+        cls itself, which would carry over into every other instance, each instance gets a subclass.
+        """
+        namespace = {}
+        properties = []
+        for name, descriptor in capabilities.items():
+            if hasattr(cls, name):
+                cls.log.warning("Not publishing %s as it would replace part of the interface!", name)
+                continue
+
+            properties.append(cls.dbusproperty.format(name = name, type = descriptor.dbustype))
+            namespace[name] = property(lambda self, key = name: self.getSetting(key),
+                lambda self, value, key = name: self.SetMany({key: value}, False))
+
+        namespace["dbus"] = cls.dbustemplate.replace("            <!-- settings -->\n", "".join(properties) + "\n")
+        return type(cls.__name__, (cls,), namespace)
+
+    def handle_file_change(self, key, value):
+        """ handle_file_change() takes over a change to a /sys attribute that was made outside of the daemon.
+
+        The settings hold the value the daemon last wrote to each attribute, so that's the value the
+        attribute is expected to hold. An event that brings it to that value is just the echo of our
+        own write (or gsd-power's write on our behalf) arriving late, and is dropped. Anything else is
+        a genuine change. It's already in the hardware, so it's saved and signalled but not written back.
+        """
+        try:
+            value = self.settings.capabilities[key].convert(int(value))
+        except ValueError:
+            self.log.warning("Ignoring unexpected value %s in %s!", value, self.settings.attrs[key].path)
+            return
 
-        if self.ignoresyschanges:
-            print(f"Ignoring changed file {path} as ignoresyschanges is True!")
+        if value == self.settings.settings[key] or value in self.inflight.get(key, []):
+            self.log.debug("%s changed to %s, which is our own write!", key, value)
+            metrics.count("events.echoes")
             return
 
-        if path == self.settings.sysfiles["usbchg"]:
-            newval = int(self.settings.sysfiles["usbchg"].read_text())
-            self.usbCharging = newval
-            self.settings.Save()
-        elif path == self.settings.sysfiles["perfmode"]:
-            newval = int(self.settings.sysfiles["perfmode"].read_text())
-            self.perfMode = newval
+        metrics.count(f"events.{key}")
+        with metrics.timed("events.handle"):
+            # A change from a client that's still queued is older than this one, so this one wins.
+            self.writequeue.discard(key)
+            self.settings.settings[key] = value
             self.settings.Save()
-        elif path == self.settings.sysfiles["kbdbacklight"]:
-            newval = int(self.settings.sysfiles["kbdbacklight"].read_text())
-            self.kbdBacklight = newval
-            self.settings.Save()
-        elif path == self.settings.sysfiles["batterySaver"]:
-            newval = int(self.settings.sysfiles["batterySaver"].read_text())
-            self.batterySaver = newval
-            self.settings.Save()
-        elif path == self.settings.sysfiles["startOnLidOpen"]:
-            newval = int(self.settings.sysfiles["startOnLidOpen"].read_text())
-            self.startOnLidOpen = newval
-            self.settings.Save()
-        else:
-            print(f"Unknown file changed: {path}!")
+            self.PropertiesChanged("org.jordynsblog.SamsungSettingsDaemon", {key: value}, [])
 
-    @staticmethod
-    def ping_systemd(user_data):
-        #print(f"[INFO]: Pinging systemd watchdog!")
-        notifier = sdnotify.SystemdNotifier()
-        notifier.notify("WATCHDOG=1")
-        return True
+    def setStatus(self, status):
+        """ setStatus() shows status in systemctl status if we're running under systemd. """
+        if self.watchdog is not None:
+            self.watchdog.status(status)
 
     def Save(self):
-        self.settings.Save()
+        # The save is queued behind any pending writes so it always saves their values.
+        self.writequeue.queue({}, True)
         return "true"
 
     def Load(self):
-        self.settings.Load()
-        self.PropertiesChanged("org.jordynsblog.SamsungSettingsDaemon", {"usbCharging": self.settings.getUSBCharging(),
-        "perfMode": self.settings.getPerfMode(),
-        "kbdBacklight": self.settings.getKeyboardBacklight(),
-        "batterySaver": self.settings.getBatterySaver(),
-        "startOnLidOpen": self.settings.getStartOnLidOpen()}, [])
+        # The saved values go through the write queue like a SetMany() would, so they replace any
+        # queued values and are written after the ones being written right now. That way nothing
+        # older can land after them, and the signals report the loaded values.
+        saved = self.settings.Read()
+        self.writequeue.queue({key: saved[key] for key in saved if key in self.settings.capabilities})
         return "true"
 
     def Restore(self):
-        self.settings.Restore()
-        self.PropertiesChanged("org.jordynsblog.SamsungSettingsDaemon", {"usbCharging": self.settings.getUSBCharging(),
-        "perfMode": self.settings.getPerfMode(),
-        "kbdBacklight": self.settings.getKeyboardBacklight(),
-        "batterySaver": self.settings.getBatterySaver(),
-        "startOnLidOpen": self.settings.getStartOnLidOpen()}, [])
+        # The settings are loaded here but written by the worker pool like any other change,
+        # and all of them are signalled once they've been written.
+        self.writequeue.flush()
+        self.settings.Load()
+        self.applySettings({key: self.settings.settings[key] for key in self.settings.capabilities}, False, signalall = True)
+        self.setStatus(f"Restored settings from {self.settings.file}")
+        return "true"
+
+    def SetMany(self, values, persist):
+        """ SetMany() lets clients change any number of settings in a single round trip.
+
+        The settings are optionally saved, and one merged PropertiesChanged signal is emitted for them.
+
+        The values are validated right away so bad ones are reported to the caller,
+        but they're written by the write queue once the current burst of calls is over.
+        pydbus can't hold back a reply, so the call returns once the values are queued
+        and clients find out they've been written from PropertiesChanged. If a write
+        fails, the signal carries the value the setting still has instead.
+        """
+        for key in values:
+            self.settings.Validate(key, values[key])
+
+        self.writequeue.queue(values, persist)
+        return "true"
+
+    def applySettings(self, values, persist, signalall = False):
+        """ applySettings() hands the collapsed changes from the write queue to the worker pool.
+
+        Each setting is written on a worker, after any earlier writes to the same setting. Once all
+        of them are done the results are picked up in the main loop, where the settings are updated,
+        saved if asked to and the ones that actually changed are signalled together. Setting a value
+        that's already set is a no-op as far as clients are concerned, unless signalall is set, in
+        which case every value in the batch is signalled.
+        """
+        batch = {"pending": len(values), "changed": {}, "persist": persist, "signalall": list(values) if signalall else []}
+        if not values:
+            self.finishBatch(batch)
+            return
+
+        for key, value in values.items():
+            self.inflight.setdefault(key, []).append(self.settings.capabilities[key].convert(value))
+            self.workers.submit(key, functools.partial(self.settings.Write, key, value), functools.partial(self.handle_written, key, batch))
+
+    def handle_written(self, key, batch, value, error):
+        attempted = self.inflight[key].pop(0)
+        if not self.inflight[key]:
+            del self.inflight[key]
+
+        if error is not None:
+            metrics.count("writes.errors")
+            self.log.error("Failed to set %s: %s", key, error)
+            self.WriteFailed(key, GLib.Variant(self.settings.capabilities[key].dbustype, attempted), str(error))
+            # Clients already show the value that failed, signalling the current one makes them go back.
+            batch["changed"][key] = self.settings.settings[key]
+        elif value != self.settings.settings[key]:
+            self.settings.settings[key] = value
+            # A newer value that's queued or being written is signalled once it lands instead.
+            if key not in self.inflight and key not in self.writequeue.pending:
+                batch["changed"][key] = value
+
+        batch["pending"] -= 1
+        if batch["pending"] == 0:
+            self.finishBatch(batch)
+
+    def finishBatch(self, batch):
+        if batch["persist"]:
+            self.settings.Save()
+
+        changed = dict(batch["changed"], **{key: self.settings.settings[key] for key in batch["signalall"]})
+        if changed:
+            self.PropertiesChanged("org.jordynsblog.SamsungSettingsDaemon", changed, [])
+
+    def getSetting(self, key):
+        """ getSetting() returns a setting's value, including changes still in the write queue or being written. """
+        return self.writequeue.get(key, self.inflight.get(key, [self.settings.settings[key]])[-1])
+
+    def GetStats(self):
+        """ GetStats() returns the daemon's metrics and save counters as a JSON string. """
+        stats = metrics.report()
+        stats["saves"] = dict(self.settings.savestats)
+        return json.dumps(stats)
+
+    def GetTelemetry(self, since, until, maxpoints):
+        """ GetTelemetry() returns the telemetry samples between since and until (0 for now) in one go.
+
+        The result is the channel names, the sample times and one array of values per channel,
+        with at most maxpoints samples (0 for no limit). Everything is empty if telemetry is off.
+        """
+        if self.telemetry is None:
+            return [], [], []
+
+        with metrics.timed("telemetry.window"):
+            return self.telemetry.window(since, until, maxpoints)
+
+    def ApplyProfile(self, name):
+        """ ApplyProfile() switches to one of the named profiles.
+
+        Only the attributes that actually differ from the hardware are written, and
+        they're all applied and signalled together through SetMany(). An attribute the
+        hardware already matches is still written if a different value for it is queued
+        or being written, as that one would land after the profile otherwise.
+        """
+        if name not in self.settings.profiles:
+            raise ValueError(f"Unknown profile {name}!")
+
+        profile = self.settings.profiles[name]
+        changed = self.settings.Diff(profile)
+        changed.update({key: value for key, value in profile.items() if key not in changed and int(self.getSetting(key)) != value})
+        self.log.debug("Applying profile %s, changing %s!", name, list(changed) or 'nothing')
+        if changed:
+            self.SetMany(changed, True)
+
         return "true"
 
+    def GetProfiles(self):
+        return sorted(self.settings.profiles)
+
+    def stepSetting(self, key, step, wrap):
+        """ stepSetting() adds step to an integer setting and returns the new value.
+
+        The value either wraps around between 0 and the setting's maximum or is clamped to that range.
+        Because the whole read-modify-write happens inside the daemon's main loop, two
+        clients (or two quick key presses) can never lose each other's steps.
+        """
+        maximum = self.settings.capabilities[key].maximum
+        value = self.getSetting(key) + step
+        if wrap:
+            value %= maximum + 1
+        else:
+            value = max(0, min(maximum, value))
+
+        self.SetMany({key: value}, True)
+        return value
+
+    def StepKeyboardBacklight(self, step, wrap):
+        return self.stepSetting("kbdBacklight", step, wrap)
+
+    def CycleKeyboardBacklight(self):
+        return self.stepSetting("kbdBacklight", 1, True)
+
+    def StepPerfMode(self, step, wrap):
+        return self.stepSetting("perfMode", step, wrap)
+
+    def CyclePerfMode(self):
+        return self.stepSetting("perfMode", 1, True)
+
     @property
     def moduleLoaded(self):
         return self.settings.IsModuleLoaded()
 
-    @property
-    def usbCharging(self):
-        return self.settings.getUSBCharging()
-
-    @usbCharging.setter
-    def usbCharging(self, value):
-        self.ignoresyschanges = True
-        self.settings.setUSBCharging(value)
-        self.ignoresyschanges = False
-        self.PropertiesChanged("org.jordynsblog.SamsungSettingsDaemon", {"usbCharging": value}, [])
-        
-    @property
-    def perfMode(self):
-        return self.settings.getPerfMode()
+class PowerSourceMonitor():
+    """ The PowerSourceMonitor() class changes settings when the laptop is plugged in or unplugged.
 
-    @perfMode.setter
-    def perfMode(self, value):
-        self.ignoresyschanges = True
-        self.settings.setPerfMode(value)
-        self.ignoresyschanges = False
-        self.PropertiesChanged("org.jordynsblog.SamsungSettingsDaemon", {"perfMode": value}, [])
+    It listens for the kernel's power_supply uevents on a netlink socket that's part of the GLib
+    main loop, so a plug event is acted on straight away and nothing wakes up in between events.
 
-    @property
-    def kbdBacklight(self):
-        return self.settings.getKeyboardBacklight()
+    The first change is applied immediately and any further changes within the debounce time
+    (flaky connectors, docks) are folded into a single change at the end of it. The settings are
+    changed through the Daemon() property setters so clients see the usual PropertiesChanged signals.
+    """
 
-    @kbdBacklight.setter
-    def kbdBacklight(self, value):
-        self.ignoresyschanges = True
-        self.settings.setKeyboardBacklight(value)
-        self.ignoresyschanges = False
-        self.PropertiesChanged("org.jordynsblog.SamsungSettingsDaemon", {"kbdBacklight": value}, [])
+    log = logging.getLogger("PowerSourceMonitor")
 
-    @property
-    def batterySaver(self):
-        return self.settings.getBatterySaver()
+    NETLINK_KOBJECT_UEVENT = 15
 
-    @batterySaver.setter
-    def batterySaver(self, value):
-        self.ignoresyschanges = True
-        self.settings.setBatterySaver(value)
-        self.ignoresyschanges = False
-        self.PropertiesChanged("org.jordynsblog.SamsungSettingsDaemon", {"batterySaver": value}, [])
+    def __init__(self, daemon, mapping, debounce = 2000):
+        self.daemon = daemon
+        self.mapping = mapping
+        self.debounce = debounce
+        self.online = None
+        self.pending = False
+        self.timer = None
+        self.sock = None
 
-    @property
-    def startOnLidOpen(self):
-        return self.settings.getStartOnLidOpen()
+    @staticmethod
+    def parseMapping(spec, settings):
+        """ parseMapping() turns a profile name or a KEY=VALUE,KEY=VALUE string into a dictonary of settings. """
+        if spec in settings.profiles:
+            return dict(settings.profiles[spec])
+
+        mapping = {}
+        for item in spec.split(","):
+            key, sep, val = item.partition("=")
+            if not sep:
+                raise ValueError(f"{spec} is neither a profile nor a list of KEY=VALUE pairs!")
+
+            if val.lower() in ["true", "on"]:
+                val = 1
+            elif val.lower() in ["false", "off"]:
+                val = 0
+            else:
+                val = int(val)
+
+            settings.Validate(key, val)
+            mapping[key] = val
+
+        return mapping
+
+    def readOnline(self):
+        """ readOnline() returns whether any mains power supply is online, or None if there aren't any. """
+        online = None
+        for supply in (Settings.sysroot / "sys/class/power_supply").glob("*"):
+            try:
+                if (supply / "type").read_text().strip() != "Mains":
+                    continue
+                online = online or (supply / "online").read_text().strip() == "1"
+            except OSError:
+                continue
 
-    @startOnLidOpen.setter
-    def startOnLidOpen(self, value):
-        self.ignoresyschanges = True
-        self.settings.setStartOnLidOpen(value)
-        self.ignoresyschanges = False
-        self.PropertiesChanged("org.jordynsblog.SamsungSettingsDaemon", {"startOnLidOpen": value}, [])
+        return online
 
-# Base code
-print(f"SamsungSettingsDaemon starting up! PID: {os.getpid()}")
+    def start(self):
+        try:
+            self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM | socket.SOCK_NONBLOCK | socket.SOCK_CLOEXEC, self.NETLINK_KOBJECT_UEVENT)
+            # Port ID 0 lets the kernel pick one for us, multicast group 1 is the kernel's uevents.
+            self.sock.bind((0, 1))
+        except OSError as e:
+            self.log.error("Cannot listen for uevents (%s), not reacting to power source changes!", e)
+            return
+
+        GLib.unix_fd_add_full(GLib.PRIORITY_DEFAULT, self.sock.fileno(), GLib.IOCondition.IN, self.handle_uevent)
+        self.update()
+
+    def handle_uevent(self, fd, condition):
+        relevant = False
+        while True:
+            try:
+                data = self.sock.recv(16384)
+            except BlockingIOError:
+                break
+
+            # A uevent is "action@devpath" followed by KEY=VALUE pairs, all NUL separated.
+            env = dict(line.split("=", 1) for line in data.decode(errors = "replace").split("\0")[1:] if "=" in line)
+            if env.get("SUBSYSTEM") == "power_supply":
+                relevant = True
+
+        if relevant:
+            self.update()
+
+        return True
+
+    def update(self):
+        if self.timer is not None:
+            # We're still debouncing the last change, the end of it will take care of this one.
+            self.pending = True
+            return
+
+        self.apply(self.readOnline())
+        self.timer = GLib.timeout_add(self.debounce, self.handle_debounce)
+
+    def handle_debounce(self):
+        self.timer = None
+        if self.pending:
+            self.pending = False
+            self.update()
+
+        return False
+
+    def apply(self, online):
+        if online is None or online == self.online:
+            return
+
+        self.online = online
+        values = self.mapping["ac" if online else "battery"]
+        self.log.info("Running on %s power, applying %s!", 'AC' if online else 'battery', values)
+        for key in values:
+            if self.daemon.getSetting(key) != values[key]:
+                setattr(self.daemon, key, values[key])
+
+        self.daemon.Save()
+
+class PerfModeGovernor():
+    """ The PerfModeGovernor() class raises and lowers perfMode with the CPU load.
+
+    Every interval seconds the CPU load is worked out from the difference between two reads of
+    /proc/stat, along with the hottest CPU temperature from hwmon. Above upthreshold load perfMode
+    goes one step up and below downthreshold one step down, and in between it stays put so it
+    doesn't flip back and forth. Reaching maxtemp always means a step down, and after that perfMode
+    doesn't go up again until the CPU has cooled below maxtemp - cooldown. The mode always stays
+    between floor and ceiling, and changes with the load no more than once every dwell seconds,
+    while a step down for maxtemp happens right away.
+
+    Changes go through the Daemon() perfMode setter like any other client's. If someone else
+    changes perfMode, that counts as a change too, so it's kept for at least dwell seconds.
+
+    While the system is idle and perfMode is already at the floor there's nothing to do, so the
+    interval doubles up to maxinterval and goes back to interval as soon as there's load again.
+    """
+
+    log = logging.getLogger("PerfModeGovernor")
+
+    upthreshold = 0.75
+    downthreshold = 0.25
+
+    # °C below maxtemp the CPU has to reach before perfMode may go up again.
+    cooldown = 10
+
+    # hwmon drivers that report the CPU's temperature
+    cpusensors = ["coretemp", "k10temp", "zenpower", "cpu_thermal"]
+
+    def __init__(self, daemon, floor = 0, ceiling = 3, dwell = 30, maxtemp = 90, interval = 2, maxinterval = 30):
+        self.daemon = daemon
+        self.floor = floor
+        self.ceiling = ceiling
+        self.dwell = dwell
+        self.maxtemp = maxtemp
+        self.mininterval = interval
+        self.maxinterval = maxinterval
+        self.interval = interval
+
+        self.stat = SysfsAttribute(Settings.sysroot / "proc/stat", readonly = True)
+        self.sensors = []
+        for hwmon in sorted((Settings.sysroot / "sys/class/hwmon").glob("hwmon*")):
+            try:
+                if (hwmon / "name").read_text().strip() not in self.cpusensors:
+                    continue
+            except OSError:
+                continue
+            self.sensors += [SysfsAttribute(file, readonly = True) for file in sorted(hwmon.glob("temp*_input"))]
+
+        self.lastsample = None
+        self.lastvalue = None
+        self.lastchange = time.monotonic()
+        self.hot = False
+
+    def start(self):
+        self.log.info("Keeping perfMode between %s and %s (%s CPU temperature sensors)!", self.floor, self.ceiling, len(self.sensors))
+        try:
+            self.lastsample = self.readStat()
+        except (OSError, ValueError, IndexError) as e:
+            self.log.error("Cannot read the CPU load (%s), not starting!", e)
+            return
+
+        self.lastvalue = self.daemon.getSetting("perfMode")
+        GLib.timeout_add_seconds(self.interval, self.handle_sample)
+
+    def readStat(self):
+        """ readStat() returns the (busy, total) CPU time from the first line of /proc/stat. """
+        fields = [int(x) for x in self.stat.read().split("\n", 1)[0].split()[1:]]
+        # idle and iowait are the time the CPUs had nothing to do.
+        idle = fields[3] + fields[4]
+        total = sum(fields[:8])
+        return total - idle, total
+
+    def readTemperature(self):
+        """ readTemperature() returns the hottest CPU sensor in °C, or None if there aren't any. """
+        temperatures = []
+        for sensor in self.sensors:
+            try:
+                temperatures.append(int(sensor.read()) / 1000)
+            except (OSError, ValueError):
+                continue
+
+        return max(temperatures, default = None)
+
+    def handle_sample(self):
+        with metrics.timed("governor.sample"):
+            try:
+                busy, total = self.readStat()
+            except (OSError, ValueError, IndexError) as e:
+                self.log.error("Cannot read the CPU load (%s), stopping!", e)
+                return False
+
+            lastbusy, lasttotal = self.lastsample
+            self.lastsample = busy, total
+            load = (busy - lastbusy) / (total - lasttotal) if total > lasttotal else 0
+            self.decide(load, self.readTemperature())
+
+        GLib.timeout_add_seconds(self.interval, self.handle_sample)
+        return False
+
+    def decide(self, load, temperature):
+        now = time.monotonic()
+        current = self.daemon.getSetting("perfMode")
+        if current != self.lastvalue:
+            self.log.debug("perfMode was changed to %s by someone else!", current)
+            self.lastvalue = current
+            self.lastchange = now
+
+        overheating = temperature is not None and temperature >= self.maxtemp
+        if overheating:
+            self.hot = True
+        elif temperature is None or temperature < self.maxtemp - self.cooldown:
+            self.hot = False
+
+        if overheating:
+            target = current - 1
+        elif load >= self.upthreshold and not self.hot:
+            target = current + 1
+        elif load <= self.downthreshold:
+            target = current - 1
+        else:
+            target = current
+        target = max(self.floor, min(self.ceiling, target))
+
+        # Nothing going on and nothing left to lower, so check less and less often.
+        if load <= self.downthreshold and target == current:
+            self.interval = min(self.interval * 2, self.maxinterval)
+        else:
+            self.interval = self.mininterval
+
+        # Cooling down can't wait for the dwell time, only the load driven changes do.
+        if target == current or (now - self.lastchange < self.dwell and not overheating):
+            return
+
+        self.log.info("CPU load is %.0f%% at %s°C, changing perfMode from %s to %s!", load * 100, temperature, current, target)
+        metrics.count("governor.changes")
+        self.daemon.perfMode = target
+        self.lastvalue = target
+        self.lastchange = now
+
+class RingBuffer():
+    """ The RingBuffer() class is a fixed size array of doubles that overwrites it's oldest value once it's full.
+
+    The values live in a single array.array, so a buffer costs 8 bytes per slot no matter how
+    long the daemon runs, and getting them back out is a couple of slice copies.
+    """
+
+    def __init__(self, size):
+        self.data = array.array("d", bytes(8 * size))
+        self.size = size
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def full(self):
+        return self.count == self.size
+
+    def append(self, value):
+        self.data[self.head] = value
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def tolist(self):
+        """ tolist() returns the values oldest first. """
+        start = (self.head - self.count) % self.size
+        if start + self.count <= self.size:
+            return self.data[start:start + self.count].tolist()
+
+        return self.data[start:].tolist() + self.data[:self.head].tolist()
+
+class Telemetry():
+    """ The Telemetry() class samples temperatures, fan speeds and battery power draw so the effect of each perfMode can be seen.
+
+    Every channel is sampled every interval seconds into a set of RingBuffer()s, one per level.
+    The first level keeps the raw samples, and every further level keeps averages of factor raw
+    samples, so the recent past is kept in detail and the more distant past at a lower resolution
+    while memory stays fixed. window() returns whichever level covers the requested time best.
 
+    Channels are found once when the class is created: every hwmon temperature (in °C) and fan
+    (in RPM) and the power draw of every battery (in W). They're read through persistent
+    SysfsAttribute() handles, and a channel that can't be read gets NaN for that sample.
+    """
+
+    log = logging.getLogger("Telemetry")
+
+    # (raw samples per value, values kept) for each level, 1 hour, 12 hours and 5 days at the default interval
+    levels = [(1, 720), (12, 720), (120, 720)]
+
+    def __init__(self, interval = 5):
+        self.interval = interval
+        self.timer = None
+
+        # name -> (handles whose values are multiplied together, scale)
+        self.channels = self.Discover()
+        self.names = list(self.channels)
+
+        # One (timestamps, [values per channel]) pair per level
+        self.rings = [(RingBuffer(size), [RingBuffer(size) for name in self.names]) for factor, size in self.levels]
+
+        # Running sums for the downsampled levels: [samples, timestamp sum, [value sums], [value counts]]
+        self.accumulators = [[0, 0.0, [0.0] * len(self.names), [0] * len(self.names)] for level in self.levels]
+
+    def Discover(self):
+        channels = {}
+        for hwmon in sorted((Settings.sysroot / "sys/class/hwmon").glob("hwmon*")):
+            try:
+                device = (hwmon / "name").read_text().strip()
+            except OSError:
+                device = hwmon.name
+
+            for kind, scale in [("temp", 0.001), ("fan", 1)]:
+                for file in sorted(hwmon.glob(f"{kind}*_input")):
+                    label = file.name[:-len("_input")]
+                    try:
+                        label = (hwmon / f"{label}_label").read_text().strip()
+                    except OSError:
+                        pass
+                    channels[f"{kind}:{device}/{label}"] = ([SysfsAttribute(file, readonly = True)], scale)
+
+        for supply in sorted((Settings.sysroot / "sys/class/power_supply").glob("*")):
+            # Batteries report either power_now (µW) or current_now (µA) and voltage_now (µV).
+            if (supply / "power_now").exists():
+                channels[f"power:{supply.name}"] = ([SysfsAttribute(supply / "power_now", readonly = True)], 1e-6)
+            elif (supply / "current_now").exists() and (supply / "voltage_now").exists():
+                channels[f"power:{supply.name}"] = ([SysfsAttribute(supply / "current_now", readonly = True), SysfsAttribute(supply / "voltage_now", readonly = True)], 1e-12)
+
+        return channels
+
+    def start(self):
+        if not self.channels:
+            self.log.warning("No hwmon or battery attributes found, not collecting telemetry!")
+            return
+
+        self.log.info("Sampling %s channels every %s seconds!", len(self.channels), self.interval)
+        self.handle_sample()
+        self.timer = GLib.timeout_add_seconds(self.interval, self.handle_sample)
+
+    def read(self, name):
+        attrs, scale = self.channels[name]
+        value = scale
+        try:
+            for attr in attrs:
+                value *= int(attr.read())
+        except (OSError, ValueError):
+            return math.nan
+
+        return value
+
+    def handle_sample(self):
+        with metrics.timed("telemetry.sample"):
+            self.record(time.time(), [self.read(name) for name in self.names])
+        return True
+
+    def record(self, timestamp, values):
+        """ record() adds a sample to the raw level and folds it into the averages of the others. """
+        timestamps, channels = self.rings[0]
+        timestamps.append(timestamp)
+        for ring, value in zip(channels, values):
+            ring.append(value)
+
+        for (factor, size), (timestamps, channels), accumulator in zip(self.levels[1:], self.rings[1:], self.accumulators[1:]):
+            accumulator[0] += 1
+            accumulator[1] += timestamp
+            for i, value in enumerate(values):
+                if not math.isnan(value):
+                    accumulator[2][i] += value
+                    accumulator[3][i] += 1
+
+            if accumulator[0] < factor:
+                continue
+
+            timestamps.append(accumulator[1] / accumulator[0])
+            for i, ring in enumerate(channels):
+                ring.append(accumulator[2][i] / accumulator[3][i] if accumulator[3][i] else math.nan)
+            accumulator[:] = [0, 0.0, [0.0] * len(values), [0] * len(values)]
+
+    def window(self, since, until, maxpoints):
+        """ window() returns (names, timestamps, values per channel) for the samples between since and until.
+
+        The finest level that still holds everything since since is used, unless it has more
+        than maxpoints samples in the window (0 for no limit), in which case a coarser one is.
+        A coarser level is only used if it has samples in the window at all, and if the level
+        that's used still has too many, every n-th sample is returned to stay within maxpoints.
+        """
+        until = until if until > 0 else math.inf
+        selected = None
+        for timestamps, channels in self.rings:
+            times = timestamps.tolist()
+            first = bisect.bisect_left(times, since)
+            last = bisect.bisect_right(times, until)
+            if selected is not None and first == last:
+                break
+
+            selected = times, channels, first, last
+            complete = not timestamps.full() or times[0] <= since
+            if complete and (not maxpoints or last - first <= maxpoints):
+                break
+
+        times, channels, first, last = selected
+        step = math.ceil((last - first) / maxpoints) if maxpoints and last - first > maxpoints else 1
+        return self.names, times[first:last:step], [ring.tolist()[first:last:step] for ring in channels]
+
+class SleepMonitor():
+    """ The SleepMonitor() class puts back settings the firmware dropped while the laptop was suspended.
+
+    It listens for logind's PrepareForSleep signal, and when it says the system has woken up, every
+    attribute is read once and compared with the settings. Only the ones that drifted are written
+    again, through the worker pool like any other write. The settings themselves didn't change, so
+    nothing is saved and no PropertiesChanged signal is sent.
+
+    The /sys watch is paused from the moment the system goes to sleep until the settings were
+    written again, otherwise a notification arriving before the wake up signal would make the
+    daemon adopt whatever the firmware reset the attributes to.
+    """
+
+    log = logging.getLogger("SleepMonitor")
+
+    def __init__(self, daemon, bus, watcher = None):
+        self.daemon = daemon
+        self.bus = bus
+        self.watcher = watcher
+
+    def start(self):
+        self.bus.subscribe(sender = "org.freedesktop.login1", iface = "org.freedesktop.login1.Manager", signal = "PrepareForSleep",
+            object = "/org/freedesktop/login1", signal_fired = self.handle_prepare_for_sleep)
+
+    def handle_prepare_for_sleep(self, sender, object, iface, signal, params):
+        sleeping, = params
+        if sleeping:
+            self.log.debug("System is going to sleep!")
+            if self.watcher is not None:
+                self.watcher.pause()
+            return
+
+        self.reapply()
+        if self.watcher is not None:
+            self.watcher.resume()
+
+    def reapply(self):
+        with metrics.timed("resume.reapply"):
+            wanted = {key: self.daemon.getSetting(key) for key in self.daemon.settings.capabilities}
+            drifted = self.daemon.settings.Diff(wanted)
+
+        if not drifted:
+            self.log.debug("System woke up with every setting intact!")
+            return
+
+        self.log.info("System woke up with %s changed, writing them again!", ', '.join(drifted))
+        metrics.count("resume.drifted", len(drifted))
+        for key, value in drifted.items():
+            self.daemon.workers.submit(key, functools.partial(self.daemon.settings.Write, key, value))
+
+class IdleExit():
+    """ The IdleExit() class shuts the daemon down once nobody has used it for timeout seconds.
+
+    Together with D-Bus activation this means the daemon (and the interpreter, GLib and pydbus
+    with it) only sits in memory while it's actually being used. Incoming method calls are noticed
+    by a filter on the bus connection, which only records the time. A single timer checks it and
+    is rescheduled for whenever the timeout could next run out, so there are no periodic wakeups.
+
+    A client that called us once and is still connected, like the GUI listening for PropertiesChanged,
+    is still using the daemon even if it doesn't call it again. So the bus name of everyone that calls
+    is watched, and the daemon doesn't exit while any of them are still on the bus. The timeout
+    starts over once the last one goes away.
+    """
+
+    log = logging.getLogger("IdleExit")
+
+    def __init__(self, bus, timeout, callback):
+        self.bus = bus
+        self.timeout = timeout
+        self.callback = callback
+        self.lastactivity = time.monotonic()
+
+        # unique bus name -> pydbus name watcher, for the clients that are still connected.
+        # This is only ever touched by the main loop.
+        self.clients = {}
+
+    def start(self):
+        self.log.info("Exiting after %s seconds without any calls!", self.timeout)
+        self.bus.con.add_filter(self.handle_message)
+        self.schedule(self.timeout)
+
+    def handle_message(self, connection, message, incoming):
+        # Filters run in GDBus' worker thread, so nothing happens here besides noting the time
+        # and handing new callers to the main loop.
+        if incoming and message.get_message_type() == Gio.DBusMessageType.METHOD_CALL:
+            self.lastactivity = time.monotonic()
+            sender = message.get_sender()
+            if sender is not None and sender not in self.clients:
+                GLib.idle_add(self.track, sender)
+
+        return message
+
+    def track(self, sender):
+        if sender not in self.clients:
+            self.log.debug("%s is using the daemon, not exiting until it disconnects!", sender)
+            self.clients[sender] = self.bus.watch_name(sender, name_vanished = functools.partial(self.handle_client_vanished, sender))
+
+        return False
+
+    def handle_client_vanished(self, sender):
+        watcher = self.clients.pop(sender, None)
+        if watcher is not None:
+            watcher.unwatch()
+
+        self.log.debug("%s disconnected, %s client(s) left!", sender, len(self.clients))
+        self.lastactivity = time.monotonic()
+
+    def schedule(self, delay):
+        GLib.timeout_add_seconds(max(1, math.ceil(delay)), self.handle_timeout)
+
+    def handle_timeout(self):
+        if self.clients:
+            self.schedule(self.timeout)
+            return False
+
+        idle = time.monotonic() - self.lastactivity
+        if idle < self.timeout:
+            self.schedule(self.timeout - idle)
+            return False
+
+        self.log.info("No calls for %.0f seconds, exiting!", idle)
+        self.callback()
+        return False
+
+class NotifySocket():
+    """ The NotifySocket() class speaks the sdnotify protocol itself, for when the sdnotify package isn't installed.
+
+    Every message is a single datagram to the AF_UNIX socket systemd passes in NOTIFY_SOCKET,
+    where a leading @ means an abstract socket. Without NOTIFY_SOCKET messages are dropped.
+    """
+
+    log = logging.getLogger("NotifySocket")
+
+    def __init__(self):
+        self.address = os.getenv("NOTIFY_SOCKET")
+        self.socket = None
+        if self.address:
+            if self.address.startswith("@"):
+                self.address = "\0" + self.address[1:]
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC)
+
+    def notify(self, state):
+        if self.socket is None:
+            return
+
+        try:
+            self.socket.sendto(state.encode(), self.address)
+        except OSError as e:
+            self.log.error("Cannot notify systemd: %s", e)
+
+class Watchdog():
+    """ The Watchdog() class handles everything systemd related using the sdnotify protocol.
+
+    It keeps a single notify socket around for readiness, STATUS= updates and watchdog pings,
+    through the sdnotify package if it's installed and NotifySocket() otherwise.
+
+    Pings are only sent if systemd asked for them by setting WATCHDOG_USEC, and then at half that
+    interval using timeout_add_seconds() so GLib can group the wakeup with others. Before each ping
+    a D-Bus Ping() is sent to the bus and the watchdog is only fed once its reply has been dispatched
+    by the main loop, so a main loop that's stuck (or a dead bus connection) gets us restarted
+    instead of kept alive by a timer.
+    """
+
+    log = logging.getLogger("Watchdog")
+
+    def __init__(self, bus):
+        self.notifier = sdnotify.SystemdNotifier() if "sdnotify" in sys.modules else NotifySocket()
+        self.bus = bus
+        self.probepending = False
+        self.interval = None
+
+        usec = os.getenv("WATCHDOG_USEC")
+        pid = os.getenv("WATCHDOG_PID")
+        if usec and (not pid or int(pid) == os.getpid()):
+            self.interval = int(usec) / 2 / 1000000
+
+    def notify(self, *lines):
+        self.notifier.notify("\n".join(lines))
+
+    def ready(self, status):
+        self.notify(f"MAINPID={os.getpid()}", "READY=1", f"STATUS={status}")
+
+    def status(self, status):
+        self.notify(f"STATUS={status}")
+
+    def start(self):
+        if self.interval is None:
+            self.log.info("systemd didn't ask for watchdog pings, not sending any!")
+            return
+
+        self.log.info("Pinging the systemd watchdog every %s seconds!", self.interval)
+        GLib.timeout_add_seconds(max(1, int(self.interval)), self.handle_tick)
+
+    def handle_tick(self):
+        if self.probepending:
+            self.log.error("The last D-Bus liveness probe never came back, not pinging the systemd watchdog!")
+            return True
+
+        self.probepending = True
+        self.bus.con.call("org.freedesktop.DBus", "/org/freedesktop/DBus", "org.freedesktop.DBus.Peer", "Ping", None, None,
+            Gio.DBusCallFlags.NONE, int(self.interval * 1000), None, self.handle_probe_reply, None)
+        return True
+
+    def handle_probe_reply(self, connection, result, user_data):
+        self.probepending = False
+        try:
+            connection.call_finish(result)
+        except GLib.GError as e:
+            self.log.error("D-Bus liveness probe failed (%s), not pinging the systemd watchdog!", e.message)
+            return
+
+        self.notify("WATCHDOG=1")
+
+# Base code
 # Argument handling
 parser = argparse.ArgumentParser(prog = "SamsungSettingsDaemon", description = "A clone of Samsung Settings for Linux using the samsung-galaxybook kernel module.")
+parser.add_argument("-R", "--sysfsroot", default = "/", type = pathlib.Path, help = "Directory containing the sys/ tree to use instead of / (for development and benchmarking)")
+parser.add_argument("-l", "--loglevel", default = "INFO", choices = ["DEBUG", "INFO", "WARNING", "ERROR"], help = "Only log messages of at least this level")
 parser.add_argument("-s", "--settingsfile", default = "settings.json", help = "Path to settings.json file")
 parser.add_argument("-i", "--ignoremodule", action = "store_true", help = "Ignore check for the samsung-galaxybook kernel module (for development)")
-parser.add_argument("-S", "--disablesystemd", action = "store_true", help = "Disables systemd support even if sdnotify is installed and systemd is active")
+parser.add_argument("-S", "--disablesystemd", action = "store_true", help = "Disables systemd support even if systemd is active, except for watchdog pings if the unit asks for them")
+parser.add_argument("-d", "--savedelay", default = 2000, type = int, help = "Milliseconds to wait before writing changed settings to disk, so bursts of changes are saved once (0 saves immediately)")
 parser.add_argument("-w", "--disablewatch", action = "store_true", help = "Disables monitoring the /sys filesystem for changes outside of SamsungSettings")
+parser.add_argument("--disableresume", action = "store_true", help = "Disables checking the settings for changes made by the firmware when the system wakes up from sleep")
+parser.add_argument("--onac", metavar = "PROFILE|KEY=VALUE,...", help = "Settings to switch to when AC power is connected, either a profile name or a list like perfMode=2,batterySaver=0")
+parser.add_argument("--onbattery", metavar = "PROFILE|KEY=VALUE,...", help = "Settings to switch to when running on battery, like --onac")
+parser.add_argument("--powerdebounce", default = 2000, type = int, help = "Milliseconds to wait for the power source to settle before acting on further changes")
+parser.add_argument("-P", "--maxpollinterval", default = 30, type = int, help = "Longest time in seconds between polls of /sys attributes that don't support sysfs_notify")
+parser.add_argument("-T", "--telemetryinterval", default = 0, type = int, help = "Seconds between temperature, fan and battery power samples for GetTelemetry() (0 disables sampling)")
+parser.add_argument("-r", "--restore", action = "store_true", help = "Restores the saved settings to the hardware and exits without connecting to D-Bus (for a oneshot unit at boot)")
+parser.add_argument("-A", "--adopt", action = "store_true", help = "Takes over the settings the hardware has at startup instead of restoring the saved ones (for on-demand starts after --restore ran at boot)")
+parser.add_argument("-I", "--idletimeout", default = 0, type = int, help = "Seconds without any D-Bus calls or connected clients after which the daemon saves and exits, for use with D-Bus activation (0 never exits)")
+parser.add_argument("-g", "--governor", metavar = "FLOOR-CEILING", help = "Raises and lowers perfMode with the CPU load, keeping it between FLOOR and CEILING (like 0-3)")
+parser.add_argument("--governordwell", default = 30, type = int, help = "Seconds the governor keeps a perfMode before changing it again")
+parser.add_argument("--governormaxtemp", default = 90, type = int, help = "CPU temperature in °C at which the governor lowers perfMode right away whatever the load")
 args = parser.parse_args()
 
+# Logging setup
+# When systemd is capturing our output, log straight to the journal instead so levels are kept.
+if "systemd.journal" in sys.modules and os.getenv("JOURNAL_STREAM"):
+    handler = journal.JournalHandler(SYSLOG_IDENTIFIER = "SamsungSettingsDaemon")
+    handler.setFormatter(logging.Formatter("[%(name)s]: %(message)s"))
+else:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("[%(levelname)s] [%(name)s]: %(message)s"))
+handler.addFilter(RateLimitFilter())
+logging.getLogger().addHandler(handler)
+logging.getLogger().setLevel(args.loglevel)
+
+log = logging.getLogger("Main")
+log.info("SamsungSettingsDaemon starting up! PID: %s", os.getpid())
+
+Settings.SetSysfsRoot(args.sysfsroot)
+
 # Check for module
 if not Settings.sysfiles["base"].exists() and not args.ignoremodule:
-    print(f"[ERROR]: samsung-galaxybook module is not loaded!")
+    log.error("samsung-galaxybook module is not loaded!")
     raise SystemExit(1)
 elif not Settings.sysfiles["base"].exists() and args.ignoremodule:
-    print(f"[NOTE]: samsung-galaxybook module is not loaded! Ignoring due to user command.")
+    log.info("samsung-galaxybook module is not loaded! Ignoring due to user command.")
+
+# Boot time restore, nothing else to do afterwards
+if args.restore:
+    started = time.perf_counter()
+    try:
+        Settings(args.settingsfile, 0, elide = False, gsdpower = False).Restore()
+    except FileNotFoundError:
+        log.info("%s not found, nothing to restore!", args.settingsfile)
+    log.info("Restored settings in %.1f ms, exiting!", (time.perf_counter() - started) * 1000)
+    raise SystemExit(0)
 
 # Setup D-Bus
 bus = pydbus.SystemBus()
-obj = Daemon()
-bus.publish("org.jordynsblog.SamsungSettingsDaemon", obj)
+obj = Daemon(Settings(args.settingsfile, args.savedelay, elide = not args.disablewatch), restore = not args.adopt)
+publication = bus.publish("org.jordynsblog.SamsungSettingsDaemon", obj)
 
 # Setup /sys watch
+watcher = None
 if not args.disablewatch:
-    leddir = Gio.File.new_for_path("/sys/class/leds/samsung-galaxybook::kbd_backlight")
-    basedir = Gio.File.new_for_path("/sys/bus/platform/devices/samsung-galaxybook")
-    ledmonitor = leddir.monitor_directory(Gio.FileMonitorFlags(0), None)
-    ledmonitor.connect("changed", obj.handle_file_change)
-    basemonitor = leddir.monitor_directory(Gio.FileMonitorFlags(0), None)
-    basemonitor.connect("changed", obj.handle_file_change)
+    watcher = SysfsWatcher(obj.settings.attrs, obj.handle_file_change, maxinterval = args.maxpollinterval)
+    watcher.start()
 else:
-    print(f"[INFO]: Not setting up /sys watched due to user command!")
+    log.info("Not setting up /sys watched due to user command!")
 
-# Notify systemd users
-if "sdnotify" in sys.modules and not args.disablesystemd:
-    print(f"[INFO]: Sending ready notification and PID to systemd!")
-    notifier = sdnotify.SystemdNotifier()
-    notifier.notify(f"MAINPID={os.getpid()}")
-    notifier.notify("READY=1")
+# Setup reapplying settings after sleep
+if not args.disableresume:
+    sleepmonitor = SleepMonitor(obj, bus, watcher)
+    sleepmonitor.start()
+else:
+    log.info("Not checking settings after sleep due to user command!")
+
+# Setup power source reactions
+if args.onac or args.onbattery:
+    try:
+        mapping = {
+            "ac": PowerSourceMonitor.parseMapping(args.onac, obj.settings) if args.onac else {},
+            "battery": PowerSourceMonitor.parseMapping(args.onbattery, obj.settings) if args.onbattery else {}
+        }
+    except ValueError as e:
+        log.error("Invalid power source mapping: %s", e)
+        raise SystemExit(1)
+
+    powermonitor = PowerSourceMonitor(obj, mapping, args.powerdebounce)
+    powermonitor.start()
+
+# Setup the perfMode governor
+if args.governor:
+    try:
+        floor, ceiling = (int(x) for x in args.governor.split("-"))
+        obj.settings.Validate("perfMode", floor)
+        obj.settings.Validate("perfMode", ceiling)
+    except ValueError as e:
+        log.error("Invalid governor range %s: %s", args.governor, e)
+        raise SystemExit(1)
+
+    governor = PerfModeGovernor(obj, min(floor, ceiling), max(floor, ceiling), args.governordwell, args.governormaxtemp)
+    governor.start()
+
+# Setup telemetry
+if args.telemetryinterval > 0:
+    obj.telemetry = Telemetry(args.telemetryinterval)
+    obj.telemetry.start()
 
-    # Setup systemd watchdog to ping every second
-    GLib.timeout_add(1000, obj.ping_systemd, None)
-elif args.disablesystemd:
-    print(f"[INFO]: Disabling systemd support due to user command!")
+# Notify systemd users
+if not args.disablesystemd:
+    log.info("Sending ready notification and PID to systemd!")
+    obj.watchdog = Watchdog(bus)
+    obj.watchdog.ready("Ready" if obj.moduleLoaded else "Ready, but samsung-galaxybook is not loaded")
+    obj.watchdog.start()
+else:
+    log.info("Disabling systemd support due to user command!")
+    # systemd kills a unit with WatchdogSec= set if nobody pings it, whatever we were told.
+    if os.getenv("WATCHDOG_USEC"):
+        log.warning("systemd still expects watchdog pings, sending only those!")
+        Watchdog(bus).start()
 
 # Main loop
 # I figure since Glib's mainloop is needed for pydbus I might as well use it for
 # file watching too.
 loop = GLib.MainLoop()
+
+# Make sure pending saves hit the disk before we go away.
+stopping = False
+def shutdown():
+    global stopping
+    if stopping:
+        return
+    stopping = True
+
+    obj.setStatus("Flushing settings and exiting")
+
+    # Giving up the name first means a call that comes in from now on starts a new instance
+    # through D-Bus activation, instead of being accepted by this one and never applied.
+    publication.unpublish()
+
+    # Draining runs the main loop, so whatever gets queued meanwhile has to be written too.
+    while True:
+        obj.writequeue.flush()
+        obj.workers.drain()
+        if not obj.writequeue.pending and not obj.writequeue.persist:
+            break
+
+    obj.settings.Flush(force = True)
+    loop.quit()
+
+def handle_shutdown_signal(signum):
+    log.info("Received signal %s, flushing settings and exiting!", signum)
+    shutdown()
+    return False
+
+for signum in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP]:
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signum, handle_shutdown_signal, signum)
+
+# Setup idle exit
+if args.idletimeout > 0 and (args.onac or args.onbattery or args.telemetryinterval > 0 or args.governor):
+    log.warning("Not exiting when idle as power source monitoring, telemetry or the governor need the daemon to keep running!")
+elif args.idletimeout > 0:
+    if not args.disableresume:
+        log.info("Settings dropped during sleep are only put back while running, SamsungSettingsResume.service takes over once exited!")
+    IdleExit(bus, args.idletimeout, shutdown).start()
+
 loop.run()